@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+from entityextractor import load_plan, WorkerPool
+
+class AsyncExtractor:
+    # Coroutine front end for the extraction engine. The CPU-bound work runs in a WorkerPool whose
+    # workers keep the compiled criteria plans warm, so the event loop is never blocked, and a worker
+    # that dies is replaced instead of failing every later call. At most max_concurrent files are in
+    # flight across all calls on one extractor.
+    #
+    #     async with AsyncExtractor(["docclass.json"], max_concurrent=8) as extractor:
+    #         rows = (await extractor.extract_pdf_async("statement.pdf"))[0]
+    #         async for pdf_path, results in extractor.iter_pdfs_async(pdf_paths):
+    #             ...
+
+    def __init__(self, criteria_files, max_workers=None, max_concurrent=None, max_pdfs_per_worker=None,
+                 max_worker_rss_mb=None, mupdf_store_mb=None):
+        # Compile once here so a broken criteria file fails before any work is queued
+        for criteria_file in criteria_files:
+            load_plan(criteria_file)
+        self.criteria_files = criteria_files
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_concurrent = max_concurrent or self.max_workers
+        self.pool = WorkerPool(criteria_files, max_workers=self.max_workers, max_pdfs_per_worker=max_pdfs_per_worker,
+                               max_worker_rss_mb=max_worker_rss_mb, mupdf_store_mb=mupdf_store_mb)
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+
+    async def extract_pdf_async(self, pdf_path, stream=None):
+        # Returns one row list per criteria file; cancelling drops the file if it has not started yet
+        async with self.slots:
+            return await asyncio.wrap_future(self.pool.submit(pdf_path, stream))
+
+    async def iter_pdfs_async(self, pdf_paths, max_concurrent=None):
+        # Yields (pdf_path, results) as each file finishes, with at most max_concurrent files of this
+        # call queued; each still takes one of the extractor's slots while it runs. Closing or
+        # cancelling the iterator cancels every file still waiting.
+        limit = max_concurrent or self.max_concurrent
+        pdf_paths = iter(pdf_paths)
+        running = {}
+
+        def fill():
+            while len(running) < limit:
+                pdf_path = next(pdf_paths, None)
+                if pdf_path is None:
+                    return
+                running[asyncio.ensure_future(self.extract_pdf_async(pdf_path))] = pdf_path
+
+        try:
+            fill()
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield running.pop(task), task.result()
+                fill()
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def aclose(self):
+        # Shut the pool down without blocking the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda: self.pool.shutdown(wait=True, cancel_futures=True))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+async def extract_pdf_async(pdf_path, criteria_file):
+    # One-off helper; keep an AsyncExtractor around instead when extracting more than one file
+    async with AsyncExtractor([criteria_file], max_workers=1) as extractor:
+        return (await extractor.extract_pdf_async(pdf_path))[0]
+
+async def iter_pdfs_async(pdf_paths, criteria_file, max_workers=None, max_concurrent=None):
+    # Yields (pdf_path, rows) for a single criteria file as each PDF finishes
+    async with AsyncExtractor([criteria_file], max_workers=max_workers, max_concurrent=max_concurrent) as extractor:
+        async for pdf_path, results in extractor.iter_pdfs_async(pdf_paths):
+            yield pdf_path, results[0]
@@ -0,0 +1,203 @@
+import json
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from entityextractor import logger, compile_plan, process_pdf_multi
+
+def init_preview_worker():
+    # Every match is logged at INFO; keep the preview workers to warnings and errors
+    logger.setLevel("WARNING")
+
+def document_key(document):
+    # Results are kept per template as it was when they were computed; any edit makes a new key
+    return json.dumps(document, sort_keys=True)
+
+# Plans compiled in this worker, by document key, so each template version is compiled (and its
+# warnings logged) once per worker instead of once per file
+preview_plans = {}
+
+def preview_pdf(pdf_path, documents):
+    # One plan per template, so each template's rows come back in their own list. Every page is
+    # still loaded once, and a box shared by several templates is read once.
+    plans = []
+    for document in documents:
+        key = document_key(document)
+        if key not in preview_plans:
+            if len(preview_plans) >= 256:
+                preview_plans.clear()
+            preview_plans[key] = compile_plan({"documents": [document]})
+        plans.append(preview_plans[key])
+    stats = {}
+    results = process_pdf_multi(pdf_path, plans, stats=stats)
+    # None marks a file that could not be opened or read, so it counts as failed, not as unmatched
+    return None if "error" in stats else results
+
+class BatchPreview:
+    # Runs the template being edited against a folder of sample PDFs in worker processes. Results
+    # are kept per (PDF, template definition), so after an edit only the templates that changed are
+    # re-run, and undoing an edit brings back results already computed, for the max_versions most
+    # recent template versions; older versions' results are dropped. Call update() with the
+    # documents whenever the template changes, collect() regularly to pick up finished files, and
+    # summary() for the figures to show.
+
+    def __init__(self, max_workers=None, max_versions=32):
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.max_versions = max_versions
+        self.versions = OrderedDict()  # document keys seen, least recently current first
+        self.executor = None
+        self.pdf_paths = []
+        self.documents = []  # [(key, document)] of the current template
+        self.results = {}  # (pdf_path, document key) -> rows, or None when the file failed
+        self.in_flight = {}  # future -> (pdf_path, [document keys])
+        self.crashed = set()  # Files that were running when a preview worker died
+
+    def set_folder(self, pdf_directory):
+        self.pdf_paths = sorted(
+            os.path.join(pdf_directory, file_name)
+            for file_name in os.listdir(pdf_directory)
+            if file_name.lower().endswith('.pdf')
+        )
+        self.results = {}
+        self.crashed = set()
+        for future in self.in_flight:
+            future.cancel()
+        self.in_flight = {}
+        if self.executor is None:
+            self.executor = self.new_executor()
+
+    def new_executor(self):
+        # Spawned, not forked: the GUI process runs Qt threads that a fork would copy mid-flight
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_preview_worker)
+
+    def submit(self, pdf_path, documents):
+        # documents are the [(key, document)] to run on pdf_path
+        try:
+            future = self.executor.submit(preview_pdf, pdf_path, [document for _, document in documents])
+        except BrokenProcessPool:
+            # A preview worker died (e.g. MuPDF crashing on a bad sample); carry on with fresh workers
+            logger.warning("A preview worker died, started fresh preview workers")
+            self.executor.shutdown(wait=False)
+            self.executor = self.new_executor()
+            future = self.executor.submit(preview_pdf, pdf_path, [document for _, document in documents])
+        self.in_flight[future] = (pdf_path, [key for key, _ in documents])
+
+    def update(self, documents):
+        self.documents = [(document_key(document), document) for document in documents]
+        wanted = {key for key, _ in self.documents}
+        for key in wanted:
+            self.versions[key] = None
+            self.versions.move_to_end(key)
+        # The current versions were just moved to the end, so only older ones are dropped
+        limit = max(self.max_versions, len(wanted))
+        if len(self.versions) > limit:
+            for _ in range(len(self.versions) - limit):
+                self.versions.popitem(last=False)
+            self.results = {result_key: rows for result_key, rows in self.results.items() if result_key[1] in self.versions}
+
+        # Files queued for templates that have since been edited are dropped before they start
+        for future, (_, keys) in list(self.in_flight.items()):
+            if wanted.isdisjoint(keys) and future.cancel():
+                del self.in_flight[future]
+
+        if self.executor is None:
+            return
+        pending = {(pdf_path, key) for pdf_path, keys in self.in_flight.values() for key in keys}
+        for pdf_path in self.pdf_paths:
+            missing = [(key, document) for key, document in self.documents
+                       if (pdf_path, key) not in self.results and (pdf_path, key) not in pending]
+            if missing:
+                self.submit(pdf_path, missing)
+
+    def collect(self):
+        # Stores the files that finished since the last call; returns True if there were any
+        finished = [future for future in self.in_flight if future.done()]
+        for future in finished:
+            pdf_path, keys = self.in_flight.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                results = future.result()
+            except BrokenProcessPool as e:
+                # Every file running when a worker dies fails with it; each is run once more, and only
+                # one that is running again when the next worker dies counts as failed
+                current = dict(self.documents)
+                documents = [(key, current[key]) for key in keys if key in current]
+                if not documents:
+                    continue  # Only for templates edited since; nothing to show or re-run
+                if pdf_path not in self.crashed and self.executor is not None:
+                    self.crashed.add(pdf_path)
+                    self.submit(pdf_path, documents)
+                    continue
+                logger.error(f"Error previewing {pdf_path}: {e}")
+                results = None
+            except Exception as e:
+                logger.error(f"Error previewing {pdf_path}: {e}")
+                results = None
+            if results is None:
+                results = [None] * len(keys)
+            for key, rows in zip(keys, results):
+                if key in self.versions:
+                    self.results[(pdf_path, key)] = rows
+        return bool(finished)
+
+    def summary(self):
+        # Per template: files done and matched, matched pages, and per entity the empty rate and a
+        # few example values. Files done are those with results for every current template.
+        documents = []
+        done = [pdf_path for pdf_path in self.pdf_paths
+                if all((pdf_path, key) in self.results for key, _ in self.documents)]
+        matched_files = set()
+        failed_files = set()
+
+        for key, document in self.documents:
+            entity_names = [entity.get("name", "Unknown") for entity in document.get("entities", []) if isinstance(entity, dict)]
+            entities = {name: {"name": name, "rows": 0, "empty": 0, "examples": []} for name in entity_names}
+            files_done = files_matched = pages = errors = 0
+            for pdf_path in self.pdf_paths:
+                if (pdf_path, key) not in self.results:
+                    continue
+                rows = self.results[(pdf_path, key)]
+                files_done += 1
+                if rows is None:
+                    errors += 1
+                    failed_files.add(pdf_path)
+                    continue
+                if rows:
+                    files_matched += 1
+                    matched_files.add(pdf_path)
+                pages += len(rows)
+                for row in rows:
+                    for name, entity in entities.items():
+                        entity["rows"] += 1
+                        value = row.get(name, "")
+                        if not value:
+                            entity["empty"] += 1
+                        elif len(entity["examples"]) < 3 and value not in entity["examples"]:
+                            entity["examples"].append(value)
+            documents.append({
+                "name": document.get("document_name", "Unknown"),
+                "files_done": files_done,
+                "files_matched": files_matched,
+                "pages": pages,
+                "errors": errors,
+                "entities": list(entities.values())
+            })
+
+        return {
+            "files": len(self.pdf_paths),
+            "done": len(done),
+            "unmatched": [os.path.basename(pdf_path) for pdf_path in done
+                          if pdf_path not in matched_files and pdf_path not in failed_files],
+            "running": len(self.in_flight),
+            "documents": documents
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.in_flight = {}
@@ -0,0 +1,74 @@
+from collections import deque
+
+# Marks a dictionary key that did not exist before a set, so undoing it removes the key again
+MISSING = object()
+
+class EditHistory:
+    # Undo/redo for the criteria JSON being edited (nested dicts and lists). Every edit goes through
+    # set(), insert(), append() or delete(), which apply it and keep only what is needed to reverse
+    # it, so an edit, an undo and a redo cost the same whatever the size of the template. Paths are
+    # keys from the root down to the container being changed, e.g. (0, "entities") for the entity
+    # list of the first document. The oldest edits are dropped past max_depth. version goes up on
+    # every edit, undo, redo and clear, so watchers can tell the template changed without comparing it.
+
+    def __init__(self, max_depth=500):
+        self.undo_stack = deque(maxlen=max_depth)
+        self.redo_stack = []
+        self.version = 0
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.version += 1  # Cleared when another template is loaded
+
+    @staticmethod
+    def container(root, path):
+        for key in path:
+            root = root[key]
+        return root
+
+    def apply(self, root, change):
+        # Applies one change and returns the change that reverses it
+        kind, path, key, value = change
+        self.version += 1
+        container = self.container(root, path)
+        if kind == "set":
+            old = container.get(key, MISSING) if isinstance(container, dict) else container[key]
+            if value is MISSING:
+                del container[key]
+            else:
+                container[key] = value
+            return ("set", path, key, old)
+        if kind == "insert":
+            container.insert(key, value)
+            return ("delete", path, key, value)
+        return ("insert", path, key, container.pop(key))
+
+    def edit(self, root, change):
+        self.undo_stack.append(self.apply(root, change))
+        self.redo_stack.clear()  # A new edit ends the redo history
+
+    def set(self, root, path, key, value):
+        self.edit(root, ("set", tuple(path), key, value))
+
+    def insert(self, root, path, index, value):
+        self.edit(root, ("insert", tuple(path), index, value))
+
+    def append(self, root, path, value):
+        self.insert(root, path, len(self.container(root, path)), value)
+
+    def delete(self, root, path, index):
+        self.edit(root, ("delete", tuple(path), index, None))
+
+    def undo(self, root):
+        # Returns False when there is nothing to undo
+        if not self.undo_stack:
+            return False
+        self.redo_stack.append(self.apply(root, self.undo_stack.pop()))
+        return True
+
+    def redo(self, root):
+        if not self.redo_stack:
+            return False
+        self.undo_stack.append(self.apply(root, self.redo_stack.pop()))
+        return True
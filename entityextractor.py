@@ -1,16 +1,42 @@
+import argparse
+import cProfile
 import fitz  # PyMuPDF
+import hashlib
+import numpy as np
 import pandas as pd
 import json
+import math
 import os
-from concurrent.futures import ThreadPoolExecutor
+import pstats
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 import logging
 from datetime import datetime
 
+# Optional: accurate RSS on every platform; /proc is read on Linux without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+        format=LOG_FORMAT,
         handlers=[
             logging.FileHandler(f'pdf_processing_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'),
             logging.StreamHandler()
@@ -18,169 +44,1493 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-logger = setup_logging()
+# Configured by the command-line entry points; importing the engine (the GUI tools, preview and
+# pool workers, other programs) adds no handlers and creates no log file
+logger = logging.getLogger(__name__)
+
+# Directory the per-thread span files are written to while tracing; None turns tracing off
+trace_directory = None
+worker_trace = threading.local()
+
+class TraceSpan:
+    # One complete ("X") event in Chrome trace format, timed on the monotonic clock shared by all processes
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = str(exc)
+        events = getattr(worker_trace, "events", None)
+        if events is None:
+            events = worker_trace.events = []
+        events.append({
+            "name": self.name,
+            "ph": "X",
+            "ts": self.start / 1000,
+            "dur": (end - self.start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": self.args
+        })
+        return False
+
+class NullSpan:
+    # Returned while tracing is off, so a span costs one global lookup and a no-op with block. Spans
+    # whose arguments are costly to build check trace_directory first and use NULL_SPAN directly.
+    def __enter__(self):
+        return self
+
+    def set(self, **args):
+        pass
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def trace_span(name, **args):
+    if trace_directory is None:
+        return NULL_SPAN
+    return TraceSpan(name, args)
 
-def process_pdf(pdf_path, criteria_file):
+def flush_trace():
+    # Append this thread's finished spans to its own file, so workers never share a file
+    events = getattr(worker_trace, "events", None)
+    if trace_directory is None or not events:
+        return
+    with open(os.path.join(trace_directory, f"trace_{os.getpid()}_{threading.get_ident()}.jsonl"), 'a') as file:
+        for event in events:
+            file.write(json.dumps(event, default=str) + "\n")
+    events.clear()
+
+def start_trace():
+    global trace_directory
+    trace_directory = tempfile.mkdtemp(prefix="pdf_trace_")
+    return trace_directory
+
+def write_trace(trace_file):
+    # Merge every thread's spans into one Chrome trace JSON file, which chrome://tracing and
+    # ui.perfetto.dev open directly, and turn tracing off again
+    global trace_directory
+    if trace_directory is None:
+        return
+    flush_trace()
+    events = []
+    threads = set()
     try:
-        # Load the JSON criteria
-        with open(criteria_file, 'r') as file:
-            criteria_data = json.load(file)
-
-        doc = fitz.open(pdf_path)
-        pdf_data = []
-
-        for document in criteria_data["documents"]:
-            document_name = document.get("document_name", "Unknown")
-
-            for page_number in range(len(doc)):
-                page = doc.load_page(page_number)
-                
-                # Check if all criteria sets are met for this page
-                all_criteria_sets_met = True
-                criteria_results = {}  # Store results for all criteria sets
-                
-                # First, check all criteria sets
-                for criteria_set in document.get("criteria_sets", []):
+        for span_file in sorted(Path(trace_directory).glob("*.jsonl")):
+            with open(span_file, 'r') as file:
+                for line in file:
+                    event = json.loads(line)
+                    events.append(event)
+                    threads.add((event["pid"], event["tid"]))
+    finally:
+        shutil.rmtree(trace_directory, ignore_errors=True)
+        trace_directory = None
+
+    # Name the tracks so the parent and each worker are easy to tell apart
+    metadata = []
+    for pid in sorted({pid for pid, _ in threads}):
+        name = "Main" if pid == os.getpid() else f"Worker {pid}"
+        metadata.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": name}})
+    for pid, tid in sorted(threads):
+        metadata.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": f"Thread {tid}"}})
+
+    events.sort(key=lambda event: event["ts"])
+    with open(trace_file, 'w') as file:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+    logger.info(f"Trace with {len(events)} spans saved to '{trace_file}'.")
+
+def criteria_box_key(box):
+    # Normalized (x0, y0, x1, y1) tuple so identical boxes across templates hash alike
+    return (
+        float(box["x"]),
+        float(box["y"]),
+        float(box["x"]) + float(box["width"]),
+        float(box["y"]) + float(box["height"])
+    )
+
+# Optional "type" of an entity in the criteria JSON; values are converted per output batch (see apply_entity_types)
+#   {"name": "Amount", "type": "decimal"}
+#   {"name": "Date", "type": "date", "format": "%m/%d/%Y"}
+#   {"name": "Account", "type": "id", "width": 10}
+# Any type may add a "pattern" regex whose first group (or whole match) is parsed, to drop labels in the box.
+ENTITY_TYPES = ("text", "decimal", "date", "id")
+
+def compile_plan(criteria_data, classify_only=False):
+    # Precompute everything process_pdf needs from the criteria JSON once, instead of per PDF/page.
+    # Templates are grouped by their distinct criteria boxes so that each box is read once per page
+    # and every criteria string on it is tested once, no matter how many templates share it.
+    # Criteria and entity rectangles are keyed by their coordinates, so the text of a rectangle used
+    # by several templates (or as both a criteria box and an entity box) is read once per page.
+    # A classify_only plan drops the entities and yields (PDF_File, NumPages, Page, Document) rows.
+    documents = []
+    boxes = {}
+    entity_types = {}  # entity name -> its type declaration, for entities that are not plain text
+    rects = {}  # (x0, y0, x1, y1) -> the one fitz.Rect shared by every box with those coordinates
+
+    def shared_rect(box_key):
+        rect = rects.get(box_key)
+        if rect is None:
+            rect = rects[box_key] = fitz.Rect(*box_key)
+        return rect
+
+    for document_index, document in enumerate(criteria_data["documents"]):
+        document_name = document.get("document_name", "Unknown")
+        criteria_keys = []
+        criteria_names = {}
+        valid = True
+
+        for criteria_set in document.get("criteria_sets", []):
+            if not isinstance(criteria_set, dict):
+                logger.warning(f"Invalid criteria_set: {criteria_set}")
+                valid = False
+                break
+
+            criteria = criteria_set.get("criteria", "")
+            criteria_box = criteria_set.get("criteria_box", None)
+
+            if not criteria_box or not isinstance(criteria_box, dict):
+                logger.warning(f"Invalid or missing 'criteria_box' for criteria '{criteria}' in document '{document_name}'")
+                valid = False
+                break
+
+            try:
+                box_key = criteria_box_key(criteria_box)
+            except Exception as e:
+                logger.error(f"Error processing criteria_set in document '{document_name}': {e}")
+                valid = False
+                break
+
+            criteria_keys.append((box_key, criteria))
+            criteria_names[criteria] = True
+
+        entities = []
+        for entity in [] if classify_only else document.get("entities", []):
+            entity_name = entity.get("name", "Unknown")
+            entity_coords = entity.get("coordinates", None)
+
+            if not entity_coords or not isinstance(entity_coords, dict):
+                logger.warning(f"Invalid or missing coordinates for entity '{entity_name}' in document '{document_name}'")
+                continue
+
+            try:
+                box_key = criteria_box_key(entity_coords)
+                entities.append((entity_name, box_key, shared_rect(box_key)))
+            except Exception as e:
+                logger.error(f"Error processing entity '{entity_name}' in document '{document_name}': {e}")
+                continue
+
+            entity_type = entity.get("type", "text")
+            if entity_type not in ENTITY_TYPES:
+                logger.warning(f"Unknown type '{entity_type}' for entity '{entity_name}' in document '{document_name}', keeping text")
+            elif entity_type != "text":
+                type_spec = {key: entity[key] for key in ("type", "format", "width", "pattern") if entity.get(key) is not None}
+                if "pattern" in type_spec:
                     try:
-                        if not isinstance(criteria_set, dict):
-                            logger.warning(f"Invalid criteria_set: {criteria_set}")
-                            all_criteria_sets_met = False
-                            break
-
-                        criteria = criteria_set.get("criteria", "")
-                        criteria_box = criteria_set.get("criteria_box", None)
-
-                        if not criteria_box or not isinstance(criteria_box, dict):
-                            logger.warning(f"Invalid or missing 'criteria_box' for criteria '{criteria}' in document '{document_name}'")
-                            all_criteria_sets_met = False
-                            break
-
-                        # Define the rectangle for the criteria box
-                        criteria_rect = fitz.Rect(
-                            criteria_box["x"],
-                            criteria_box["y"],
-                            criteria_box["x"] + criteria_box["width"],
-                            criteria_box["y"] + criteria_box["height"]
-                        )
-
-                        # Extract text within the criteria box
-                        criteria_clip_text = page.get_text("text", clip=criteria_rect)
-                        #print(f"File: {os.path.basename(pdf_path)}:\t|\tCriteria: {criteria}\t|\tClippedText: {criteria_clip_text}")
-                        # Store the result for this criteria
-                        criteria_met = criteria in criteria_clip_text
-                        criteria_results[criteria] = criteria_met
-
-                        if not criteria_met:
-                            all_criteria_sets_met = False
-                            break
-
-                    except Exception as e:
-                        logger.error(f"Error processing criteria_set in document '{document_name}', page {page_number + 1}: {e}")
-                        all_criteria_sets_met = False
-                        break
-
-                # Only process entities if ALL criteria sets were met
-                if all_criteria_sets_met:
-                    logger.info(f"{os.path.basename(pdf_path)} | {document_name} | All criteria met for document '{document_name}' on page {page_number + 1}")
-                    
-                    # Create base entity data
-                    entity_data = {
-                        "Document": document_name,
-                        "Page": page_number + 1,
-                        "Criteria_Met": ", ".join(criteria_results.keys()),  # List all met criteria
-                        "PDF_File": Path(pdf_path).name,
-                        "NumPages": len(doc)
-                    }
-
-                    # Process entities
-                    for entity in document.get("entities", []):
-                        try:
-                            entity_name = entity.get("name", "Unknown")
-                            entity_coords = entity.get("coordinates", None)
-
-                            if not entity_coords or not isinstance(entity_coords, dict):
-                                logger.warning(f"Invalid or missing coordinates for entity '{entity_name}' in document '{document_name}'")
-                                continue
+                        re.compile(type_spec["pattern"])
+                    except (re.error, TypeError) as e:
+                        logger.warning(f"Invalid pattern for entity '{entity_name}' in document '{document_name}', ignoring it: {e}")
+                        del type_spec["pattern"]
+                if entity_types.setdefault(entity_name, type_spec) != type_spec:
+                    # One output column per entity name, so the first declaration wins
+                    logger.warning(f"Conflicting type for entity '{entity_name}' in document '{document_name}', using {entity_types[entity_name]}")
 
-                            # Define the rectangle for the entity box
-                            entity_rect = fitz.Rect(
-                                entity_coords["x"],
-                                entity_coords["y"],
-                                entity_coords["x"] + entity_coords["width"],
-                                entity_coords["y"] + entity_coords["height"]
-                            )
+        documents.append({
+            "name": document_name,
+            "valid": valid,
+            "criteria_met": ", ".join(criteria_names.keys()),  # List all met criteria
+            "entities": entities
+        })
 
-                            # Extract text within the entity box
-                            entity_clip_text = ' '.join(page.get_text("text", clip=entity_rect).split()).strip()
+        if not valid:
+            continue
 
-                            # Add the extracted entity information to the entity_data dictionary
-                            entity_data[entity_name] = entity_clip_text
+        for box_key, criteria in criteria_keys:
+            box = boxes.setdefault(box_key, {"key": box_key, "rect": shared_rect(box_key), "criteria": {}, "documents": set()})
+            box["criteria"].setdefault(criteria, set()).add(document_index)
+            box["documents"].add(document_index)
 
-                        except Exception as e:
-                            logger.error(f"Error processing entity '{entity_name}' in document '{document_name}', page {page_number + 1}: {e}")
+    # Boxes shared by the most templates first: one read there rules out the most candidates
+    ordered_boxes = sorted(boxes.values(), key=lambda box: len(box["documents"]), reverse=True)
 
-                    # Append the entity data only if we processed all entities
-                    pdf_data.append(entity_data)
-                else:
-                    logger.debug(f"Not all criteria met for document '{document_name}' on page {page_number + 1}")
-        doc.close()
-        return pdf_data
+    return {
+        "classify_only": classify_only,
+        "documents": documents,
+        "boxes": ordered_boxes,
+        "candidates": {index for index, document in enumerate(documents) if document["valid"]},
+        "entity_types": entity_types
+    }
+
+def load_plan(criteria_file, classify_only=False):
+    # Load the JSON criteria
+    with open(criteria_file, 'r') as file:
+        criteria_data = json.load(file)
+    return compile_plan(criteria_data, classify_only)
+
+def clip_text(page, box_key, rect, clip_texts=None):
+    # Text inside rect. clip_texts (box key -> text) is shared by every lookup on one page, so a
+    # rectangle is read once however many templates, plans or entities refer to it.
+    if clip_texts is None:
+        return page.get_text("text", clip=rect)
+    text = clip_texts.get(box_key)
+    if text is None:
+        text = clip_texts[box_key] = page.get_text("text", clip=rect)
+    return text
+
+def classify_page(page, plan, page_number, clip_texts=None):
+    # Returns the indexes of the documents whose criteria sets are all met on this page
+    candidates = set(plan["candidates"])
+
+    for box in plan["boxes"]:
+        # Skip boxes that can no longer change the outcome
+        if candidates.isdisjoint(box["documents"]):
+            continue
+
+        # The criteria list is only built while tracing; this runs for every box on every page
+        span = NULL_SPAN if trace_directory is None else trace_span("criteria", page=page_number + 1, criteria=list(box["criteria"]))
+        with span:
+            try:
+                # Extract text within the criteria box, once for every template sharing it
+                criteria_clip_text = clip_text(page, box["key"], box["rect"], clip_texts)
+            except Exception as e:
+                logger.error(f"Error processing criteria box {tuple(box['rect'])} on page {page_number + 1}: {e}")
+                candidates -= box["documents"]
+                continue
+
+            for criteria, document_indexes in box["criteria"].items():
+                if criteria not in criteria_clip_text:
+                    candidates -= document_indexes
+            span.set(candidates_left=len(candidates))
+
+        if not candidates:
+            break
+
+    return sorted(candidates)
+
+def extract_entities(page, document, page_number, clip_texts=None):
+    entity_values = {}
+    for entity_name, box_key, entity_rect in document["entities"]:
+        try:
+            # Extract text within the entity box
+            entity_values[entity_name] = ' '.join(clip_text(page, box_key, entity_rect, clip_texts).split()).strip()
+        except Exception as e:
+            logger.error(f"Error processing entity '{entity_name}' in document '{document['name']}', page {page_number + 1}: {e}")
+    return entity_values
+
+def process_pdf_multi(pdf_path, plans, stream=None, stats=None):
+    # Open and load each page once, evaluate every plan against it and keep each plan's rows apart.
+    # With stream the PDF bytes are parsed from memory and pdf_path only names the file.
+    # A stats dict, when given, receives the page count and the seconds spent, and the error when the
+    # file could not be processed (its rows are then empty).
+    started = time.perf_counter()
+    pdf_name = Path(pdf_path).name
+    try:
+        with trace_span("pdf", pdf=pdf_name) as pdf_span:
+            with trace_span("open", pdf=pdf_name, from_memory=stream is not None):
+                doc = fitz.open(stage_pdf(pdf_path)) if stream is None else fitz.open(stream=stream, filetype="pdf")
+            num_pages = len(doc)
+            pdf_span.set(pages=num_pages)
+            if stats is not None:
+                stats["pages"] = num_pages
+            document_rows = [[[] for _ in plan["documents"]] for plan in plans]
+
+            for page_number in range(num_pages):
+                with trace_span("page", pdf=pdf_name, page=page_number + 1) as page_span:
+                    page = doc.load_page(page_number)
+                    clip_texts = {}
+
+                    for plan, plan_rows in zip(plans, document_rows):
+                        for document_index in classify_page(page, plan, page_number, clip_texts):
+                            document = plan["documents"][document_index]
+                            logger.info(f"{os.path.basename(pdf_path)} | {document['name']} | All criteria met for document '{document['name']}' on page {page_number + 1}")
+                            page_span.set(document=document["name"])
+
+                            if plan["classify_only"]:
+                                plan_rows[document_index].append({
+                                    "PDF_File": pdf_name,
+                                    "NumPages": num_pages,
+                                    "Page": page_number + 1,
+                                    "Document": document["name"]
+                                })
+                                continue
+
+                            # Create base entity data
+                            entity_data = {
+                                "Document": document["name"],
+                                "Page": page_number + 1,
+                                "Criteria_Met": document["criteria_met"],
+                                "PDF_File": pdf_name,
+                                "NumPages": num_pages
+                            }
+                            with trace_span("extract", pdf=pdf_name, page=page_number + 1, document=document["name"]):
+                                entity_data.update(extract_entities(page, document, page_number, clip_texts))
+                            plan_rows[document_index].append(entity_data)
+
+            doc.close()
+
+        # Keep the document-major row order of the per-template scan
+        results = []
+        for plan_rows in document_rows:
+            pdf_data = []
+            for rows in plan_rows:
+                pdf_data.extend(rows)
+            results.append(pdf_data)
+        return results
+    except Exception as e:
+        logger.error(f"Error processing {pdf_path}: {e}")
+        if stats is not None:
+            stats["error"] = str(e)
+        return [[] for _ in plans]
+    finally:
+        if stats is not None:
+            stats["seconds"] = time.perf_counter() - started
+
+def process_pdf(pdf_path, criteria_file, plan=None):
+    try:
+        if plan is None:
+            plan = load_plan(criteria_file)
     except Exception as e:
         logger.error(f"Error processing {pdf_path}: {e}")
         return []
+    return process_pdf_multi(pdf_path, [plan])[0]
 
-def process_all_pdfs(pdf_directory, criteria_file):
-    pdf_files = [os.path.join(pdf_directory, f) for f in os.listdir(pdf_directory) if f.lower().endswith('.pdf')]
-    
-    all_data = []
-    with ThreadPoolExecutor() as executor:
-        # Map PDF files to the worker function
-        results = list(executor.map(lambda x: process_pdf(x, criteria_file), pdf_files))
+# Plans preloaded once per worker process by init_worker
+worker_plans = []
+
+# Directory each worker dumps its cProfile stats into when profiling is on
+profile_directory = None
+worker_profile = threading.local()
+
+# Size in MB the MuPDF store is trimmed back to after every file; None leaves it alone, 0 empties it
+mupdf_store_limit_mb = None
+
+class StagingCache:
+    # Local copies of input PDFs, e.g. on an SSD in front of an SMB share, so repeat runs over the
+    # same folders read local disk. Entries are keyed by source path, size and mtime, so a changed
+    # source is copied again, and the least recently used entries are deleted once the cache is over
+    # max_size_mb. The directory may be shared by several processes; state lives on disk, and each
+    # process keeps a running total of the cache size from its last scan plus its own copies, so the
+    # directory is only scanned again once that total passes the cap.
+
+    def __init__(self, directory, max_size_mb=10240):
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # The cap may have been lowered since the last run
+        try:
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Could not trim the staging cache {directory}: {e}")
+
+    def entry_path(self, pdf_path, stat):
+        key = hashlib.sha1(f"{os.path.abspath(pdf_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key[:20]}_{Path(pdf_path).name}")
+
+    def local_path(self, pdf_path):
+        # Path to read pdf_path from, copying it into the cache on a miss. Falls back to the source
+        # on any cache error, so a full or missing cache disk never fails the file.
+        try:
+            stat = os.stat(pdf_path)
+            entry = self.entry_path(pdf_path, stat)
+            try:
+                # Mark as recently used; eviction goes by the entries' mtimes
+                os.utime(entry)
+                return entry
+            except FileNotFoundError:
+                pass
+
+            if stat.st_size > self.max_size:
+                return pdf_path
+            partial = f"{entry}.{os.getpid()}_{threading.get_ident()}.part"
+            try:
+                shutil.copyfile(pdf_path, partial)
+                os.replace(partial, entry)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            with self.lock:
+                self.size += stat.st_size
+                over = self.size > self.max_size
+            if over:
+                self.evict(keep=entry)
+            return entry
+        except OSError as e:
+            logger.warning(f"Staging cache unavailable for {pdf_path}, reading it in place: {e}")
+            return pdf_path
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # Evicted by another process meanwhile
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        # Down to 90% of the cap, so the next copies fit without scanning the directory again
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue  # Still open in another process (Windows); it stays and counts
+            total -= size
+        with self.lock:
+            self.size = total
+
+# Set by process_all_pdfs_multi / init_worker when input PDFs should be staged to local disk first
+staging_cache = None
+
+def stage_pdf(pdf_path):
+    return staging_cache.local_path(pdf_path) if staging_cache is not None else pdf_path
+
+def worker_log_config():
+    # How this process logs, for workers to copy: (log file or None, root level, engine logger level),
+    # or None when logging was never set up here
+    root = logging.getLogger()
+    if not root.handlers:
+        return None
+    log_files = [handler.baseFilename for handler in root.handlers if isinstance(handler, logging.FileHandler)]
+    return (log_files[0] if log_files else None, root.level, logger.level)
+
+def init_worker_logging(log_config):
+    # Forked workers inherit the parent's handlers; spawned ones (max_tasks_per_child, or platforms
+    # without fork) start with none, so they get the same log file, console output and levels
+    if log_config is None or logging.getLogger().handlers:
+        return
+    log_file, root_level, engine_level = log_config
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    logging.basicConfig(level=root_level, format=LOG_FORMAT, handlers=handlers)
+    logger.setLevel(engine_level)
+
+def init_worker(criteria_files, profile_dir=None, store_limit_mb=None, classify_only=False, trace_dir=None,
+                stage_dir=None, stage_max_mb=10240, log_config=None):
+    global worker_plans, profile_directory, mupdf_store_limit_mb, trace_directory, staging_cache
+    init_worker_logging(log_config)
+    worker_plans = [load_plan(criteria_file, classify_only) for criteria_file in criteria_files]
+    profile_directory = profile_dir
+    mupdf_store_limit_mb = store_limit_mb
+    trace_directory = trace_dir
+    staging_cache = StagingCache(stage_dir, stage_max_mb) if stage_dir else None
+
+def limit_mupdf_store():
+    # fitz caches fonts, images and parsed objects in one global store that otherwise only shrinks
+    # when it hits MuPDF's built-in maximum; trim it between files to keep long runs flat
+    if mupdf_store_limit_mb is None:
+        return
+    try:
+        store_size = fitz.TOOLS.store_size
+        if callable(store_size):
+            # A property in older PyMuPDF releases, a method in newer ones
+            store_size = store_size()
+        store_limit = mupdf_store_limit_mb * 1024 * 1024
+        if not isinstance(store_size, (int, float)):
+            # Newer releases no longer report the size (the method returns None): empty the store
+            fitz.TOOLS.store_shrink(100)
+        elif store_size > store_limit:
+            # store_shrink takes the percentage of the store to free
+            fitz.TOOLS.store_shrink(100 if store_limit == 0 else math.ceil(100 * (store_size - store_limit) / store_size))
+    except Exception as e:
+        # The cap only keeps memory flat; it must never fail the file it runs after
+        logger.warning(f"Could not trim the MuPDF store: {e}")
+
+def current_rss_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        # Linux without psutil: resident pages are the second field of statm
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def run_profiled(function, *args):
+    # One profile per worker thread/process, accumulated over every file it handles and re-dumped
+    # after each file, so the parent can merge whatever the workers got through
+    if profile_directory is None:
+        return function(*args)
+
+    if getattr(worker_profile, "profile", None) is None:
+        worker_profile.profile = cProfile.Profile()
+        worker_profile.path = os.path.join(profile_directory, f"worker_{os.getpid()}_{threading.get_ident()}.prof")
+
+    worker_profile.profile.enable()
+    try:
+        return function(*args)
+    finally:
+        worker_profile.profile.disable()
+        worker_profile.profile.dump_stats(worker_profile.path)
+
+def process_pdf_worker(pdf_path, stream=None, stats=None):
+    try:
+        return run_profiled(process_pdf_multi, pdf_path, worker_plans, stream, stats)
+    finally:
+        limit_mupdf_store()
+        flush_trace()
+
+def process_pdf_worker_stats(pdf_path, stream=None, compact=False):
+    # Same as process_pdf_worker, plus the worker's pid, RSS, and the page count and seconds spent,
+    # so the parent can track, recycle and tune the workers and record per-file costs.
+    # With compact, each row list is sent back as a RowAccumulator: the integer and code columns
+    # pickle as flat buffers and repeated keys and values once, instead of one dict per row.
+    stats = {}
+    results = process_pdf_worker(pdf_path, stream, stats)
+    if compact:
+        batches = []
+        for pdf_data in results:
+            batch = RowAccumulator()
+            batch.extend(pdf_data)
+            batches.append(batch)
+        results = batches
+    return results, os.getpid(), current_rss_mb(), stats
+
+class WorkerPool:
+    # Process pool whose workers keep the plans warm. Workers are replaced after max_pdfs_per_worker
+    # files, and the whole pool is swapped for fresh workers once any worker reports more than
+    # max_worker_rss_mb resident memory. Files already running finish on the old workers. A worker
+    # that dies (e.g. MuPDF crashing on a bad PDF) breaks the whole executor; it is replaced, and the
+    # files that were running on it are retried one at a time on a separate single worker, so only
+    # the file that crashes a worker fails.
+
+    def __init__(self, criteria_files, max_workers=None, max_pdfs_per_worker=None, max_worker_rss_mb=None,
+                 mupdf_store_mb=None, profile_dir=None, classify_only=False, compact=False, trace_dir=None,
+                 stage_dir=None, stage_max_mb=10240):
+        self.initargs = (criteria_files, profile_dir, mupdf_store_mb, classify_only, trace_dir, stage_dir, stage_max_mb,
+                         worker_log_config())
+        self.compact = compact  # Futures resolve to RowAccumulator batches instead of row lists
+        self.max_workers = max_workers
+        self.max_pdfs_per_worker = max_pdfs_per_worker
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.worker_stats = {}  # pid -> {"pdfs", "rss_mb", "peak_rss_mb"}
+        self.pages_processed = 0
+        self.file_seconds = {}  # pdf_path -> seconds spent processing it
+        self.retired_executors = []
+        self.recycle_requested = False
+        self.retries = deque()  # (pdf_path, stream, result, strict) of files caught in a broken pool
+        self.retry_executor = None  # Single worker the retries run on, one file at a time
+        self.retrying = False
+        self.closed = False  # Set by shutdown; a closed pool never starts new workers
+        self.lock = threading.Lock()
+        self.executor = self.new_executor()
+
+    def new_executor(self, max_workers=None):
+        options = {"max_tasks_per_child": self.max_pdfs_per_worker} if self.max_pdfs_per_worker else {}
+        return ProcessPoolExecutor(max_workers=max_workers or self.max_workers, initializer=init_worker, initargs=self.initargs, **options)
+
+    def replace_broken(self, executor):
+        # Swaps a broken executor for fresh workers; a no-op if another file already replaced it, or
+        # once the pool is shut down (e.g. retired by a criteria reload with files still running)
+        with self.lock:
+            if executor is self.executor and not self.closed:
+                self.retired_executors.append(executor)
+                self.executor = self.new_executor()
+                logger.warning("A worker process died, started fresh worker processes")
+            return self.executor
+
+    def record(self, pdf_path, executor, pid, rss_mb, file_stats):
+        with self.lock:
+            self.pages_processed += file_stats.get("pages", 0)
+            if "seconds" in file_stats:
+                self.file_seconds[pdf_path] = file_stats["seconds"]
+            stats = self.worker_stats.setdefault(pid, {"pdfs": 0, "rss_mb": None, "peak_rss_mb": None})
+            stats["pdfs"] += 1
+            if rss_mb is not None:
+                stats["rss_mb"] = rss_mb
+                stats["peak_rss_mb"] = max(stats["peak_rss_mb"] or 0, rss_mb)
+                if self.max_worker_rss_mb and rss_mb > self.max_worker_rss_mb and executor is self.executor and not self.recycle_requested:
+                    logger.warning(f"Worker {pid} RSS {rss_mb:.0f} MB is over the {self.max_worker_rss_mb} MB limit, recycling workers")
+                    self.recycle_requested = True
+
+    @staticmethod
+    def settle(result, value=None, error=None):
+        # The caller may have cancelled result in the meantime; the late outcome is then dropped
+        try:
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(value)
+        except InvalidStateError:
+            pass
+
+    def resolve(self, result, pdf_path, results, file_stats, strict):
+        if strict and "error" in file_stats:
+            self.settle(result, error=ValueError(f"Could not read {os.path.basename(pdf_path)}: {file_stats['error']}"))
+        else:
+            self.settle(result, results)
+
+    def submit(self, pdf_path, stream=None, strict=False):
+        # Cancelling the returned future drops the file if it has not started yet. With strict, a file
+        # that cannot be opened or read fails the future with a ValueError instead of giving no rows.
+        with self.lock:
+            if self.recycle_requested:
+                self.recycle_requested = False
+                self.retired_executors.append(self.executor)
+                self.executor.shutdown(wait=False)
+                self.executor = self.new_executor()
+                logger.info("Started fresh worker processes after a worker exceeded the RSS limit")
+            executor = self.executor
+
+        result = Future()
+
+        def finished(future):
+            if future.cancelled():
+                result.cancel()
+                return
+            try:
+                results, pid, rss_mb, file_stats = future.result()
+            except BrokenProcessPool:
+                # Any file running on the executor is caught when one worker dies; which one killed
+                # it is found by running them again alone
+                self.replace_broken(executor)
+                if not result.cancelled():
+                    self.retry(pdf_path, stream, result, strict)
+                return
+            except Exception as e:
+                self.settle(result, error=e)
+                return
+            self.record(pdf_path, executor, pid, rss_mb, file_stats)
+            self.resolve(result, pdf_path, results, file_stats, strict)
+
+        try:
+            submitted = executor.submit(process_pdf_worker_stats, pdf_path, stream, self.compact)
+        except BrokenProcessPool:
+            # The pool broke between files; the file never started, so it goes straight to new workers
+            executor = self.replace_broken(executor)
+            submitted = executor.submit(process_pdf_worker_stats, pdf_path, stream, self.compact)
+        submitted.add_done_callback(finished)
+        result.add_done_callback(lambda _: result.cancelled() and submitted.cancel())
+        return result
+
+    def retry(self, pdf_path, stream, result, strict):
+        with self.lock:
+            self.retries.append((pdf_path, stream, result, strict))
+            if self.retrying:
+                return
+            self.retrying = True
+        self.retry_next()
+
+    def retry_next(self):
+        with self.lock:
+            while self.retries and self.retries[0][2].cancelled():
+                self.retries.popleft()
+            if not self.retries or self.closed:
+                abandoned = list(self.retries)
+                self.retries.clear()
+                self.retrying = False
+            else:
+                abandoned = None
+                pdf_path, stream, result, strict = self.retries.popleft()
+                if self.retry_executor is None:
+                    self.retry_executor = self.new_executor(max_workers=1)
+                executor = self.retry_executor
+        if abandoned is not None:
+            for pdf_path, _, result, _ in abandoned:
+                self.settle(result, error=BrokenProcessPool(f"Worker died while processing {pdf_path} after the pool was shut down"))
+            return
+
+        def finished(future):
+            try:
+                results, pid, rss_mb, file_stats = future.result()
+            except BrokenProcessPool as e:
+                # It crashed a worker on its own, so this file is the one to blame
+                logger.error(f"Worker died while processing {pdf_path}, giving up on this file")
+                with self.lock:
+                    if self.retry_executor is executor:
+                        self.retired_executors.append(executor)
+                        self.retry_executor = None
+                self.settle(result, error=e)
+            except Exception as e:
+                self.settle(result, error=e)
+            else:
+                self.record(pdf_path, executor, pid, rss_mb, file_stats)
+                self.resolve(result, pdf_path, results, file_stats, strict)
+            self.retry_next()
+
+        try:
+            submitted = executor.submit(process_pdf_worker_stats, pdf_path, stream, self.compact)
+        except RuntimeError as e:
+            # Shut down meanwhile
+            self.settle(result, error=e)
+            self.retry_next()
+            return
+        submitted.add_done_callback(finished)
+
+    def log_worker_stats(self):
+        for pid, stats in sorted(self.worker_stats.items()):
+            if stats["rss_mb"] is None:
+                logger.info(f"Worker {pid}: {stats['pdfs']} PDFs")
+            else:
+                logger.info(f"Worker {pid}: {stats['pdfs']} PDFs, RSS {stats['rss_mb']:.0f} MB (peak {stats['peak_rss_mb']:.0f} MB)")
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.lock:
+            self.closed = True
+        for executor in self.retired_executors + [self.executor, self.retry_executor]:
+            if executor is not None:
+                executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        self.retired_executors = []
+
+def is_mupdf_function(function):
+    return any(part in ('fitz', 'pymupdf') for part in Path(function[0]).parts)
+
+def write_profile_report(profile_dir, report_file, limit=60):
+    # Merge the per-worker profiles and split MuPDF time (everything below a fitz call) from Python time
+    profile_files = sorted(Path(profile_dir).glob("*.prof"))
+    if not profile_files:
+        logger.warning("No worker profiles were recorded")
+        return
+
+    with open(report_file, 'w') as report:
+        stats = pstats.Stats(*[str(profile_file) for profile_file in profile_files], stream=report)
+
+        mupdf_calls = {}
+        for function, (_, _, _, _, callers) in stats.stats.items():
+            if not is_mupdf_function(function):
+                continue
+            for caller, caller_stats in callers.items():
+                # Only entry points from Python code into fitz, so nested fitz calls are not counted twice
+                if not is_mupdf_function(caller):
+                    mupdf_calls[function[2]] = mupdf_calls.get(function[2], 0.0) + caller_stats[3]
+
+        mupdf_time = sum(mupdf_calls.values())
+        report.write(f"Workers profiled: {len(profile_files)}\n")
+        report.write(f"Total profiled time: {stats.total_tt:.3f}s\n")
+        report.write(f"MuPDF time: {mupdf_time:.3f}s\n")
+        for function_name, seconds in sorted(mupdf_calls.items(), key=lambda item: item[1], reverse=True):
+            report.write(f"    {function_name}: {seconds:.3f}s\n")
+        report.write(f"Python time: {stats.total_tt - mupdf_time:.3f}s\n\n")
+
+        stats.sort_stats("cumulative").print_stats(limit)
+        stats.dump_stats(f"{os.path.splitext(report_file)[0]}.prof")
+
+    logger.info(f"Profile report saved to '{report_file}'.")
+
+class RowAccumulator:
+    # Column-wise store for extraction rows, for callers that keep a whole batch in memory.
+    # Page numbers live in int64 arrays, the Document / Criteria_Met / PDF_File values that repeat on
+    # every row are dictionary-encoded, and entity strings are interned. Rows missing an entity get None.
+    ENCODED_COLUMNS = ("Document", "Criteria_Met", "PDF_File")
+    INTEGER_COLUMNS = ("Page", "NumPages")  # Present on every row
+
+    def __init__(self):
+        self.length = 0
+        self.columns = {}  # name -> array, list, or (codes, value -> code, values) for encoded columns
+
+    def __len__(self):
+        return self.length
+
+    def new_column(self, name):
+        if name in self.ENCODED_COLUMNS:
+            return (array('q', [-1]) * self.length, {}, [])
+        if name in self.INTEGER_COLUMNS:
+            return array('q', [0]) * self.length
+        return [None] * self.length
+
+    def append(self, row):
+        for name, value in row.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = self.new_column(name)
+
+            if name in self.ENCODED_COLUMNS:
+                codes, lookup, values = column
+                if value is None:
+                    codes.append(-1)
+                    continue
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(values)
+                    values.append(value)
+                codes.append(code)
+            elif name in self.INTEGER_COLUMNS:
+                column.append(value)
+            else:
+                column.append(sys.intern(value) if isinstance(value, str) else value)
+
+        self.length += 1
+        if len(row) < len(self.columns):
+            # Pad the entity columns this row's document does not have
+            for name, column in self.columns.items():
+                if name not in row:
+                    if name in self.ENCODED_COLUMNS:
+                        column[0].append(-1)
+                    elif name in self.INTEGER_COLUMNS:
+                        column.append(0)
+                    else:
+                        column.append(None)
+
+    def extend(self, rows):
+        if isinstance(rows, RowAccumulator):
+            self.extend_batch(rows)
+            return
+        for row in rows:
+            self.append(row)
+
+    def extend_batch(self, batch):
+        # Merge another accumulator column by column, e.g. a batch sent back by a worker process.
+        # Only the encoded values are looked at one by one; codes, integers and entities are bulk copied.
+        if not batch.length:
+            return
+        for name, other in batch.columns.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = self.new_column(name)
+
+            if name in self.ENCODED_COLUMNS:
+                codes, lookup, values = column
+                other_codes, _, other_values = other
+                recode = []
+                for value in other_values:
+                    code = lookup.get(value)
+                    if code is None:
+                        code = lookup[value] = len(values)
+                        values.append(value)
+                    recode.append(code)
+                recode.append(-1)  # So a missing value (-1) stays missing
+                codes.frombytes(np.asarray(recode, dtype=np.int64)[np.frombuffer(other_codes, dtype=np.int64)].tobytes())
+            else:
+                column.extend(other)
+
+        self.length += batch.length
+        if len(batch.columns) < len(self.columns):
+            for name, column in self.columns.items():
+                if name not in batch.columns:
+                    if name in self.ENCODED_COLUMNS:
+                        column[0].extend(array('q', [-1]) * batch.length)
+                    elif name in self.INTEGER_COLUMNS:
+                        column.extend(array('q', [0]) * batch.length)
+                    else:
+                        column.extend([None] * batch.length)
+
+    def to_dataframe(self):
+        # The integer arrays are handed to pandas as zero-copy views, so call this once accumulation is done
+        data = {}
+        for name, column in self.columns.items():
+            if name in self.ENCODED_COLUMNS:
+                codes, _, values = column
+                data[name] = pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.int64), categories=values)
+            elif name in self.INTEGER_COLUMNS:
+                data[name] = np.frombuffer(column, dtype=np.int64)
+            else:
+                data[name] = column
+        return pd.DataFrame(data, copy=False)
+
+def process_all_pdfs_multi(pdf_directory, criteria_files, profile_file=None, backend="thread", max_workers=None,
+                           max_pdfs_per_worker=None, max_worker_rss_mb=None, mupdf_store_mb=None, compact=False,
+                           io_threads=None, autotune=False, worker_bounds=None, io_thread_bounds=(1, 32),
+                           classify_only=False, schedule="size", cost_history_file=None, trace_file=None,
+                           stage_directory=None, stage_max_mb=10240, pool=None):
+    # Returns one row list per criteria file, or one RowAccumulator per criteria file with compact.
+    # io_threads reads files ahead of the workers on that many threads; autotune adjusts both the
+    # worker and I/O thread counts while the batch runs, within worker_bounds and io_thread_bounds.
+    # pdf_directory may also be a ZIP/TAR archive, or a list of directories and archives.
+    # classify_only skips entity extraction and returns (PDF_File, NumPages, Page, Document) rows.
+    # schedule orders the files by estimated cost, largest first (see list_pdf_sources); per-file
+    # seconds are read from and saved back to cost_history_file.
+    # trace_file receives a Chrome trace of every file, page, criteria check and extraction; when a
+    # trace was already started with start_trace, the caller writes it instead.
+    # stage_directory copies input PDFs to a local cache directory, capped at stage_max_mb, on first
+    # read, and repeat runs read them from there (see StagingCache).
+    # pool runs the process backend on an existing WorkerPool, started with the same criteria files,
+    # instead of a new one, and is left running; its workers keep their own worker options.
+    global profile_directory, mupdf_store_limit_mb, staging_cache
+    trace_owned = bool(trace_file) and trace_directory is None
+    if trace_owned:
+        start_trace()
+    cost_history = load_cost_history(cost_history_file) if cost_history_file else {}
+    file_seconds = {}
+    pdf_sources = list_pdf_sources(pdf_directory, schedule, cost_history)
+
+    plans = [load_plan(criteria_file, classify_only) for criteria_file in criteria_files]
+
+    profile_temp = tempfile.TemporaryDirectory() if profile_file else None
+    profile_directory = profile_temp.name if profile_temp else None
+    mupdf_store_limit_mb = mupdf_store_mb
+    staging_cache = StagingCache(stage_directory, stage_max_mb) if stage_directory else None
+
+    if profile_temp and backend == "thread" and sys.version_info >= (3, 12):
+        # cProfile can only be active once per process from 3.12 on, so profile worker processes instead
+        backend = "process"
+
+    tuner = None
+    if autotune:
+        cpu_count = os.cpu_count() or 1
+        worker_bounds = worker_bounds or (1, cpu_count if backend == "process" else 2 * cpu_count)
+        tuner = ConcurrencyTuner(
+            workers=max_workers or min(cpu_count, worker_bounds[1]),
+            io_threads=io_threads or io_thread_bounds[0],
+            worker_bounds=worker_bounds,
+            io_thread_bounds=io_thread_bounds
+        )
+        # Pools are sized for the upper bound; the tuner decides how many are kept busy
+        max_workers = worker_bounds[1]
+        io_threads = io_thread_bounds[1]
+
+    all_data = [RowAccumulator() if compact else [] for _ in plans]
+
+    def collect(results):
+        # Fold each file's rows in as it finishes, so only the accumulated rows stay in memory
         for result in results:
-            all_data.extend(result)
+            span = NULL_SPAN if trace_directory is None else trace_span("collect", rows=[len(pdf_data) for pdf_data in result])
+            with span:
+                for plan_data, pdf_data in zip(all_data, result):
+                    plan_data.extend(pdf_data)
+
+    try:
+        if backend == "process":
+            pool_owned = pool is None
+            pool = pool or WorkerPool(
+                criteria_files,
+                max_workers=max_workers,
+                max_pdfs_per_worker=max_pdfs_per_worker,
+                max_worker_rss_mb=max_worker_rss_mb,
+                mupdf_store_mb=mupdf_store_mb,
+                profile_dir=profile_directory,
+                classify_only=classify_only,
+                compact=compact,
+                trace_dir=trace_directory,
+                stage_dir=stage_directory,
+                stage_max_mb=stage_max_mb
+            )
+            try:
+                if io_threads:
+                    collect(process_pdfs_read_ahead(pdf_sources, pool.submit, lambda: pool.pages_processed,
+                                                    max_workers or os.cpu_count() or 1, io_threads, tuner, [[] for _ in plans]))
+                else:
+                    collect(process_pdfs_in_window(pdf_sources, pool.submit, 2 * (max_workers or os.cpu_count() or 1),
+                                                   [[] for _ in plans]))
+            finally:
+                if pool_owned:
+                    pool.shutdown(wait=True)
+                pool.log_worker_stats()
+                file_seconds.update(pool.file_seconds)
+        else:
+            pages_processed = [0]
+            pages_lock = threading.Lock()
+
+            def worker(pdf_path, stream=None):
+                stats = {}
+                try:
+                    return run_profiled(process_pdf_multi, pdf_path, plans, stream, stats)
+                finally:
+                    limit_mupdf_store()
+                    flush_trace()
+                    with pages_lock:
+                        pages_processed[0] += stats.get("pages", 0)
+                        if "seconds" in stats:
+                            file_seconds[pdf_path] = stats["seconds"]
+
+            # Same default as ThreadPoolExecutor
+            thread_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+            with ThreadPoolExecutor(max_workers=thread_workers) as executor:
+                submit = lambda pdf_path, stream: executor.submit(worker, pdf_path, stream)
+                if io_threads:
+                    collect(process_pdfs_read_ahead(pdf_sources, submit, lambda: pages_processed[0], thread_workers,
+                                                    io_threads, tuner, [[] for _ in plans]))
+                else:
+                    # Map PDF files to the worker function
+                    collect(process_pdfs_in_window(pdf_sources, submit, 2 * thread_workers, [[] for _ in plans]))
+
+        if tuner:
+            tuner.log_final()
+        if cost_history_file:
+            cost_history.update(file_seconds)
+            save_cost_history(cost_history_file, cost_history)
+        if profile_temp:
+            write_profile_report(profile_temp.name, profile_file)
+    finally:
+        mupdf_store_limit_mb = None
+        staging_cache = None
+        if profile_temp:
+            profile_directory = None
+            profile_temp.cleanup()
+        if trace_owned:
+            write_trace(trace_file)
 
     return all_data
 
-def main():
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+def is_archive(path):
+    return os.path.isfile(path) and str(path).lower().endswith(ARCHIVE_EXTENSIONS)
+
+# Errors reading one archive member: corrupt data, a bad CRC, an encrypted member or a truncated file
+ARCHIVE_MEMBER_ERRORS = (OSError, zipfile.BadZipFile, tarfile.TarError, zlib.error, RuntimeError, EOFError, ValueError)
+
+def iter_archive_pdfs(archive_path):
+    # Yields (member name, bytes) for every PDF in a ZIP or TAR archive without extracting to disk.
+    # A member that cannot be read is logged and skipped, like a bad loose PDF.
+    if str(archive_path).lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.pdf'):
+                    try:
+                        stream = archive.read(info)
+                    except ARCHIVE_MEMBER_ERRORS as e:
+                        logger.error(f"Error reading {info.filename} in {archive_path}: {e}")
+                        continue
+                    yield info.filename, stream
+    else:
+        # Stream mode reads a compressed tar front to back once instead of seeking for every member.
+        # A corrupt compressed stream cannot be resumed past, so that ends the archive (see iter_archive_sources).
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith('.pdf'):
+                    try:
+                        stream = archive.extractfile(member).read()
+                    except ARCHIVE_MEMBER_ERRORS as e:
+                        logger.error(f"Error reading {member.name} in {archive_path}: {e}")
+                        continue
+                    yield member.name, stream
+
+def iter_archive_sources(archive_path):
     try:
-        # Directory containing PDF files
-        pdf_directory = r"S:\CLA\August 2024 FF\August 2024 FF Files\it2\it3\it4"
-        criteria_file = r"C:\Users\aliner\Desktop\JSON\docclass.json"
-        output_file = r'S:\CLA\Classification\extracted_entities2.csv'
-        
+        for member_name, stream in iter_archive_pdfs(archive_path):
+            yield member_name, stream
+    except ARCHIVE_MEMBER_ERRORS as e:
+        logger.error(f"Error reading archive {archive_path}: {e}")
 
-        logger.info("Starting PDF processing...")
-        # Process all PDFs
-        pdf_files_data = process_all_pdfs(pdf_directory, criteria_file)
+def load_cost_history(cost_history_file):
+    # Seconds each file took in earlier runs, keyed by path
+    if not os.path.exists(cost_history_file):
+        return {}
+    try:
+        with open(cost_history_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable cost history '{cost_history_file}': {e}")
+        return {}
+
+def save_cost_history(cost_history_file, cost_history):
+    with open(cost_history_file, 'w') as file:
+        json.dump(cost_history, file, indent=4)
+
+def estimate_pdf_costs(pdf_paths, schedule="size", cost_history=None):
+    # Estimated processing cost per file. "size" uses the file size, "pages" opens each file for its
+    # page count. Files with a recorded cost in cost_history use it, and the others are scaled by the
+    # recorded seconds per byte (or page) so both kinds of estimate sort together.
+    measures = {}
+    for pdf_path in pdf_paths:
+        try:
+            if schedule == "pages":
+                with fitz.open(pdf_path) as doc:
+                    measures[pdf_path] = len(doc)
+            else:
+                measures[pdf_path] = os.path.getsize(pdf_path)
+        except Exception as e:
+            logger.warning(f"Could not estimate the cost of {pdf_path}: {e}")
+            measures[pdf_path] = 0
+
+    cost_history = cost_history or {}
+    known = [(cost_history[pdf_path], measures[pdf_path]) for pdf_path in pdf_paths if pdf_path in cost_history]
+    known_measure = sum(measure for _, measure in known)
+    rate = sum(seconds for seconds, _ in known) / known_measure if known_measure else 1.0
+    return {pdf_path: cost_history.get(pdf_path, measures[pdf_path] * rate) for pdf_path in pdf_paths}
 
-        # Create a DataFrame with the extracted data
+def list_pdf_sources(pdf_inputs, schedule="listing", cost_history=None):
+    # Yields (pdf_path, stream) pairs. PDFs in directories are opened by the workers (stream is None);
+    # archive members come with their bytes and are named by the member, so PDF_File stays the file name.
+    # With schedule "size" or "pages" the directory files are yielded longest-processing-time first,
+    # so large files start early instead of leaving one worker busy after the rest have finished.
+    # Archive members always stream in archive order, after the directory files.
+    if isinstance(pdf_inputs, (str, os.PathLike)):
+        pdf_inputs = [pdf_inputs]
+
+    if schedule == "listing":
+        for pdf_input in pdf_inputs:
+            if is_archive(pdf_input):
+                yield from iter_archive_sources(pdf_input)
+            else:
+                for f in os.listdir(pdf_input):
+                    if f.lower().endswith('.pdf'):
+                        yield os.path.join(pdf_input, f), None
+        return
+
+    pdf_paths = []
+    archives = []
+    for pdf_input in pdf_inputs:
+        if is_archive(pdf_input):
+            archives.append(pdf_input)
+        else:
+            pdf_paths.extend(os.path.join(pdf_input, f) for f in os.listdir(pdf_input) if f.lower().endswith('.pdf'))
+
+    costs = estimate_pdf_costs(pdf_paths, schedule, cost_history)
+    for pdf_path in sorted(pdf_paths, key=costs.get, reverse=True):
+        yield pdf_path, None
+    for archive_path in archives:
+        yield from iter_archive_sources(archive_path)
+
+def file_result(future, pdf_path, empty_result):
+    # A file whose worker failed (e.g. it crashed a process worker) is logged and yields empty_result,
+    # as the thread backend does for a file it cannot read, instead of aborting the whole batch
+    try:
+        return future.result()
+    except Exception as e:
+        logger.error(f"Error processing {pdf_path}: {e}")
+        return empty_result
+
+def process_pdfs_in_window(pdf_sources, submit, window, empty_result=None):
+    # Yields each file's results in source order. Only a bounded window of files is submitted at a time,
+    # so recycled workers pick up the rest of the batch and neither results nor archive bytes pile up.
+    # submit(pdf_path, stream) returns a future of the results.
+    finished = {}
+    in_flight = {}
+    next_index = 0
+    for index, (pdf_path, stream) in enumerate(pdf_sources):
+        in_flight[submit(pdf_path, stream)] = (index, pdf_path)
+        while len(in_flight) >= window:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                done_index, done_path = in_flight.pop(future)
+                finished[done_index] = file_result(future, done_path, empty_result)
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+    for future in as_completed(in_flight):
+        done_index, done_path = in_flight[future]
+        finished[done_index] = file_result(future, done_path, empty_result)
+        while next_index in finished:
+            yield finished.pop(next_index)
+            next_index += 1
+
+def read_pdf_bytes(pdf_path):
+    try:
+        with trace_span("read", pdf=Path(pdf_path).name):
+            with open(stage_pdf(pdf_path), 'rb') as file:
+                return file.read()
+    finally:
+        flush_trace()
+
+def process_pdfs_read_ahead(pdf_sources, submit_parse, pages_processed, workers, io_threads, tuner=None, empty_result=None):
+    # Yields each file's results in source order. I/O threads read whole files into memory ahead of
+    # the workers, which parse from the buffered bytes, so share latency overlaps with parsing.
+    # submit_parse(pdf_path, stream) returns a future of the results; pages_processed() the page total.
+    pdf_sources = enumerate(pdf_sources)
+    exhausted = False
+    pdf_paths = {}  # index -> pdf_path, for files not yet handed to a worker
+    finished = {}
+    reads = {}  # future -> index
+    parses = {}  # future -> (index, pdf_path)
+    buffered = deque()  # (index, bytes)
+    next_index = 0
+    last_wait = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=io_threads) as reader:
+        while not exhausted or reads or buffered or parses:
+            io_limit = tuner.io_threads if tuner else io_threads
+            worker_limit = tuner.workers if tuner else workers
+
+            # Keep the readers busy, but hold no more than two files per worker in memory
+            while not exhausted and len(reads) < io_limit and len(reads) + len(buffered) < io_limit + 2 * worker_limit:
+                index, (pdf_path, stream) = next(pdf_sources, (None, (None, None)))
+                if index is None:
+                    exhausted = True
+                    break
+                pdf_paths[index] = pdf_path
+                if stream is None:
+                    reads[reader.submit(read_pdf_bytes, pdf_path)] = index
+                else:
+                    # Archive members arrive already read
+                    buffered.append((index, stream))
+            while buffered and len(parses) < worker_limit:
+                index, stream = buffered.popleft()
+                pdf_path = pdf_paths.pop(index)
+                parses[submit_parse(pdf_path, stream)] = (index, pdf_path)
+
+            if not reads and not parses:
+                continue
+
+            # Share of the workers left idle only because their next file is still being read
+            idle_share = (worker_limit - len(parses)) / worker_limit if reads and not buffered else 0.0
+
+            done, _ = wait(list(reads) + list(parses), return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            if tuner:
+                tuner.record_io_wait(idle_share * (now - last_wait))
+            last_wait = now
+
+            for future in done:
+                if future in reads:
+                    index = reads.pop(future)
+                    try:
+                        buffered.append((index, future.result()))
+                    except OSError as e:
+                        logger.error(f"Error processing {pdf_paths.pop(index)}: {e}")
+                        finished[index] = empty_result
+                else:
+                    index, pdf_path = parses.pop(future)
+                    finished[index] = file_result(future, pdf_path, empty_result)
+
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+            if tuner:
+                tuner.maybe_adjust(pages_processed())
+
+class ConcurrencyTuner:
+    # Adjusts the worker and read-ahead I/O thread counts from the measured pages/sec and I/O wait.
+    # While workers sit idle waiting on reads the I/O threads are doubled; otherwise the worker count
+    # is hill-climbed one step per interval, turning around when a step does not improve throughput.
+
+    def __init__(self, workers, io_threads, worker_bounds, io_thread_bounds, interval=5.0,
+                 io_wait_high=0.2, io_wait_low=0.02, min_gain=0.05):
+        self.min_workers, self.max_workers = worker_bounds
+        self.min_io_threads, self.max_io_threads = io_thread_bounds
+        self.workers = max(self.min_workers, min(self.max_workers, workers))
+        self.io_threads = max(self.min_io_threads, min(self.max_io_threads, io_threads))
+        self.interval = interval
+        self.io_wait_high = io_wait_high
+        self.io_wait_low = io_wait_low
+        self.min_gain = min_gain
+        self.direction = 1
+        self.last_throughput = None
+        self.interval_start = time.monotonic()
+        self.interval_pages = 0
+        self.io_wait = 0.0
+
+    def record_io_wait(self, seconds):
+        self.io_wait += seconds
+
+    def maybe_adjust(self, pages_processed):
+        now = time.monotonic()
+        elapsed = now - self.interval_start
+        if elapsed < self.interval:
+            return
+
+        throughput = (pages_processed - self.interval_pages) / elapsed
+        io_wait = min(1.0, self.io_wait / elapsed)
+        settings = (self.workers, self.io_threads)
+
+        if io_wait > self.io_wait_high and self.io_threads < self.max_io_threads:
+            # Workers are starved by slow storage: read further ahead
+            self.io_threads = min(self.max_io_threads, self.io_threads * 2)
+        else:
+            if io_wait < self.io_wait_low and self.io_threads > self.min_io_threads:
+                self.io_threads -= 1
+            if self.last_throughput is not None and throughput < self.last_throughput * (1 + self.min_gain):
+                # The last step did not pay off, turn around
+                self.direction = -self.direction
+            self.workers = max(self.min_workers, min(self.max_workers, self.workers + self.direction))
+
+        if (self.workers, self.io_threads) != settings:
+            logger.info(f"Auto-tune: {throughput:.1f} pages/sec, I/O wait {io_wait:.0%} -> {self.workers} workers, {self.io_threads} I/O threads")
+
+        self.last_throughput = throughput
+        self.interval_start = now
+        self.interval_pages = pages_processed
+        self.io_wait = 0.0
+
+    def log_final(self):
+        logger.info(f"Auto-tune settled on {self.workers} workers and {self.io_threads} I/O threads; pin them with --workers {self.workers} --io-threads {self.io_threads}")
+
+def process_all_pdfs(pdf_directory, criteria_file):
+    return process_all_pdfs_multi(pdf_directory, [criteria_file])[0]
+
+def apply_entity_types(df, entity_types):
+    # Convert the typed entity columns of a batch in place, one vectorized step per column. Values
+    # that do not parse become empty (NaN / NaT / <NA>) and are counted rather than raising.
+    # Returns entity name -> number of invalid values.
+    invalid = {}
+    for entity_name, type_spec in entity_types.items():
+        if entity_name not in df.columns:
+            continue
+        values = df[entity_name].astype("string").str.strip()
+        present = values.notna() & (values != "")
+
+        pattern = type_spec.get("pattern")
+        if pattern:
+            # Always a one-column-per-group frame, so patterns with several groups keep the first
+            values = values.str.extract(pattern if re.compile(pattern).groups else f"({pattern})", expand=True).iloc[:, 0]
+
+        entity_type = type_spec["type"]
+        if entity_type == "decimal":
+            # "$1,234.50", "(1,234.50)" and "1,234.50-" are all read as amounts
+            # Only currency symbols, thousands separators, sign and parentheses are dropped; anything else
+            # ("Page 1 of 3", "12-31-2024") stays and fails to parse, so it is counted as invalid
+            values = values.str.replace(r"[\s$€£¥₹,]", "", regex=True)
+            negative = values.str.contains(r"^\(.*\)$|^-|-$", regex=True).fillna(False).astype(bool)
+            values = values.str.replace(r"^\((.*)\)$", r"\1", regex=True).str.replace(r"^[+-]|-$", "", regex=True)
+            parsed = pd.to_numeric(values.replace("", pd.NA), errors="coerce").astype("float64")
+            parsed = parsed.where(~negative, -parsed)
+        elif entity_type == "date":
+            parsed = pd.to_datetime(values, format=type_spec.get("format"), errors="coerce")
+        else:
+            # Digits only once whitespace is removed; "12.5" or "Page 2 of 5" is not an id
+            values = values.str.replace(r"\s", "", regex=True)
+            parsed = values.where(values.str.fullmatch(r"\d+").fillna(False).astype(bool))
+            if type_spec.get("width"):
+                parsed = parsed.str.zfill(int(type_spec["width"]))
+
+        count = int((present & parsed.isna()).sum())
+        if count:
+            invalid[entity_name] = count
+            logger.warning(f"{count} '{entity_name}' values are not a valid {entity_type} and were left empty")
+        df[entity_name] = parsed
+    return invalid
+
+def write_output(pdf_files_data, output_file, entity_types=None):
+    # Create a DataFrame with the extracted data
+    if not len(pdf_files_data):
+        df = pd.DataFrame(columns=['Document', 'Page', 'Criteria_Met', 'PDF_File', 'NumPages'])
+    elif isinstance(pdf_files_data, RowAccumulator):
+        df = pdf_files_data.to_dataframe()
+    else:
         df = pd.DataFrame(pdf_files_data)
+    if entity_types:
+        apply_entity_types(df, entity_types)
+
+    df['AccountNumber'] = df['PDF_File'].astype(str).str[:10]
+    #Document	Page	Criteria_Met	PDF_File	document
+    ignorelist = ['AccountNumber', 'PDF_File', 'Page', 'Document', 'NumPages', 'criteria', 'document']
+    columnlist = [column for column in df.columns if column not in ignorelist]
+    columnlist.insert(0, 'AccountNumber')
+    columnlist.insert(1, 'PDF_File')
+    columnlist.insert(2, 'NumPages')
+    columnlist.insert(3, 'Page')
+    columnlist.insert(4, 'Document')
+
+    output_df = df[columnlist].copy()
+    output_df['AccountNumber'] = output_df['AccountNumber'].astype(str).str.zfill(10)
+    # Save the DataFrame to a CSV file
+    output_df.to_csv(output_file, index=False)
+
+    logger.info(f"Entity extraction complete. Processed {len(pdf_files_data)} matches.")
+    logger.info(f"Data saved to '{output_file}'.")
+    return df
 
-        df['AccountNumber'] = df['PDF_File'].astype(str).str[:10]
-        #Document	Page	Criteria_Met	PDF_File	document
-        ignorelist = ['AccountNumber', 'PDF_File', 'Page', 'Document', 'NumPages', 'criteria', 'document']
-        columnlist = [column for column in df.columns if column not in ignorelist]
-        columnlist.insert(0, 'AccountNumber')
-        columnlist.insert(1, 'PDF_File')
-        columnlist.insert(2, 'NumPages')
-        columnlist.insert(3, 'Page')
-        columnlist.insert(4, 'Document')
-        
-        output_df = df[columnlist]
-        output_df['AccountNumber'] = output_df['AccountNumber'].astype(str).str.zfill(10)
-        # Save the DataFrame to a CSV file
-        output_df.to_csv(output_file, index=False)
+def plan_columns(plan):
+    # Fixed output columns for a plan, so rows can be appended batch by batch
+    columns = ['AccountNumber', 'PDF_File', 'NumPages', 'Page', 'Document']
+    if plan["classify_only"]:
+        return columns
+    columns.append('Criteria_Met')
+    for document in plan["documents"]:
+        for entity_name, _, _ in document["entities"]:
+            if entity_name not in columns:
+                columns.append(entity_name)
+    return columns
 
-        #Document	Page	Criteria_Met	PDF_File	document
+def append_output(pdf_files_data, output_file, columns, entity_types=None):
+    # Append rows to an existing CSV, starting a new file if its header no longer matches the plan
+    if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+        header = pd.read_csv(output_file, nrows=0).columns.tolist()
+        if header != columns:
+            stem, ext = os.path.splitext(output_file)
+            rolled_file = f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
+            logger.warning(f"Columns of '{output_file}' no longer match the criteria, writing to '{rolled_file}'")
+            output_file = rolled_file
 
-        logger.info(f"Entity extraction complete. Processed {len(pdf_files_data)} matches.")
-        logger.info(f"Data saved to '{output_file}'.")
+    df = pd.DataFrame(pdf_files_data).reindex(columns=columns)
+    if entity_types:
+        apply_entity_types(df, entity_types)
+    df['AccountNumber'] = df['PDF_File'].astype(str).str[:10].str.zfill(10)
+    write_header = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
+    df.to_csv(output_file, mode='a', index=False, header=write_header)
+    return output_file
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Classify PDF pages and extract entities using docclass criteria files.")
+    # Directories containing PDF files, or ZIP/TAR archives of PDFs read without extracting
+    parser.add_argument("--pdf-directory", nargs="+", default=[r"S:\CLA\August 2024 FF\August 2024 FF Files\it2\it3\it4"])
+    # One output file per criteria file, matched by position
+    parser.add_argument("--criteria", nargs="+", default=[r"C:\Users\aliner\Desktop\JSON\docclass.json"])
+    parser.add_argument("--output", nargs="+", default=[r'S:\CLA\Classification\extracted_entities2.csv'])
+    # Profile every worker and write a merged report sorted by cumulative time
+    parser.add_argument("--profile", nargs="?", const="profile_report.txt", default=None, metavar="REPORT_FILE")
+    # Per-file span trace, viewable in ui.perfetto.dev or chrome://tracing
+    parser.add_argument("--trace", nargs="?", const="pdf_trace.json", default=None, metavar="TRACE_FILE")
+    parser.add_argument("--backend", choices=["thread", "process"], default="thread")
+    parser.add_argument("--workers", type=int, default=None)
+    # Read files ahead of the workers on this many threads (useful on high-latency shares)
+    parser.add_argument("--io-threads", type=int, default=None)
+    # Adjust workers and I/O threads from measured pages/sec and I/O wait, within the bounds
+    parser.add_argument("--autotune", action="store_true")
+    # Only classify pages: output PDF_File, NumPages, Page and Document without extracting entities
+    parser.add_argument("--classify-only", action="store_true")
+    # Order files by estimated cost, largest first; "listing" keeps the directory order
+    parser.add_argument("--schedule", choices=["size", "pages", "listing"], default="size")
+    parser.add_argument("--cost-history", default=None, help="JSON file of per-file seconds, used for scheduling and updated after the run")
+    parser.add_argument("--worker-bounds", type=int, nargs=2, default=None, metavar=("MIN", "MAX"))
+    parser.add_argument("--io-thread-bounds", type=int, nargs=2, default=(1, 32), metavar=("MIN", "MAX"))
+    # Memory bounds for long runs; the per-worker limits need --backend process
+    parser.add_argument("--max-pdfs-per-worker", type=int, default=None)
+    parser.add_argument("--max-worker-rss-mb", type=float, default=None)
+    # Local copy of the input PDFs, e.g. on SSD, for repeat runs over network shares
+    parser.add_argument("--stage-dir", default=None, help="Cache input PDFs in this local directory on first read")
+    parser.add_argument("--stage-max-mb", type=float, default=10240, help="Size cap of the --stage-dir cache; least recently used files go first")
+    parser.add_argument("--mupdf-store-mb", type=float, default=None, help="Trim the MuPDF store to this size after each file (0 empties it)")
+    args = parser.parse_args(argv)
+
+    if len(args.criteria) != len(args.output):
+        parser.error("--criteria and --output must be given the same number of files")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    if args.trace:
+        start_trace()
+    try:
+        logger.info("Starting PDF processing...")
+        # Process all PDFs once for every criteria file
+        all_plans_data = process_all_pdfs_multi(
+            args.pdf_directory, args.criteria,
+            profile_file=args.profile,
+            backend=args.backend,
+            compact=True,
+            max_workers=args.workers,
+            max_pdfs_per_worker=args.max_pdfs_per_worker,
+            max_worker_rss_mb=args.max_worker_rss_mb,
+            mupdf_store_mb=args.mupdf_store_mb,
+            io_threads=args.io_threads,
+            autotune=args.autotune,
+            worker_bounds=args.worker_bounds,
+            io_thread_bounds=args.io_thread_bounds,
+            classify_only=args.classify_only,
+            schedule=args.schedule,
+            cost_history_file=args.cost_history,
+            stage_directory=args.stage_dir,
+            stage_max_mb=args.stage_max_mb
+        )
 
-        print(df)
+        for criteria_file, output_file, pdf_files_data in zip(args.criteria, args.output, all_plans_data):
+            logger.info(f"Writing results for criteria file '{criteria_file}'")
+            entity_types = load_plan(criteria_file, args.classify_only)["entity_types"]
+            with trace_span("output", output_file=output_file, rows=len(pdf_files_data)):
+                df = write_output(pdf_files_data, output_file, entity_types)
+            print(df)
 
     except Exception as e:
         logger.error("Fatal error in main execution", exc_info=True)
         raise
+    finally:
+        if args.trace:
+            write_trace(args.trace)
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,12 @@
 import sys
 import fitz  # PyMuPDF
 from PyQt6 import QtWidgets, QtGui, QtCore
-from PIL import Image
 import json
 
+from batchpreview import BatchPreview
+from edithistory import EditHistory
+from pdfviewer import PageRenderer, PageView, box_from_points
+
 class PDFAnnotationTool(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
@@ -22,9 +25,20 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.selected_criteria_set_index = None
         self.selected_entity_index = None
 
-        # Undo/Redo Stacks
-        self.undo_stack = []
-        self.redo_stack = []
+        # Undo/Redo: each edit keeps only the change, for the last 500 edits
+        self.history = EditHistory(max_depth=500)
+
+        # Batch preview of the template against a sample folder; finished files are picked up, and
+        # template edits sent out, every 250 ms
+        self.batch_preview = BatchPreview()
+        self.preview_version = None  # History version the preview last ran
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.timeout.connect(self.update_batch_preview)
+
+        # Renders pages in the background and caches them by (page, zoom), capped in memory
+        self.renderer = PageRenderer(max_mb=256, parent=self)
+        self.renderer.rendered.connect(self.page_rendered)
+        self.renderer.tile_rendered.connect(self.tile_rendered)
 
         # UI Setup
         self.setup_ui()
@@ -39,20 +53,17 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         viewer_layout = QtWidgets.QVBoxLayout()
         sidebar_layout = QtWidgets.QVBoxLayout()
 
-        # Viewer Area
-        self.viewer = QtWidgets.QLabel(self)
-        self.viewer.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop | QtCore.Qt.AlignmentFlag.AlignLeft)
-        self.viewer.setMouseTracking(True)
-        self.viewer.mousePressEvent = self.start_draw_rectangle
-        self.viewer.mouseMoveEvent = self.update_rectangle
-        self.viewer.mouseReleaseEvent = self.finish_rectangle
-        self.viewer.wheelEvent = self.handle_wheel_event  # Add mouse wheel event for zoom in and out
-
-        viewer_scroll_area = QtWidgets.QScrollArea()
-        viewer_scroll_area.setWidgetResizable(True)
-        viewer_scroll_area.setWidget(self.viewer)
-        viewer_scroll_area.setStyleSheet("border: 2px solid #ccc; background-color: white;")
-        viewer_layout.addWidget(viewer_scroll_area)
+        # Viewer Area: the page and its boxes are scene items, zoom is the view transform
+        self.viewer = PageView(self)
+        self.viewer.pressed.connect(self.start_draw_rectangle)
+        self.viewer.moved.connect(self.update_rectangle)
+        self.viewer.released.connect(self.finish_rectangle)
+        self.viewer.zoom_requested.connect(self.handle_wheel_event)  # Ctrl + mouse wheel zooms in and out
+        self.viewer.box_changed.connect(self.box_changed)  # Boxes moved or resized on the page
+        self.viewer.viewport_changed.connect(self.request_tiles)  # Sharp tiles for what is on screen at high zoom
+        self.viewer.hovered.connect(self.hover_word)  # Highlight the word under the cursor
+        self.viewer.setStyleSheet("border: 2px solid #ccc; background-color: white;")
+        viewer_layout.addWidget(self.viewer)
 
         # Toolbar
         toolbar = QtWidgets.QToolBar()
@@ -192,6 +203,23 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
 
         sidebar_tabs.addTab(undo_redo_tab, "Undo/Redo")
 
+        # Batch Preview Tab: match and empty rates of the template across a folder of sample PDFs
+        preview_tab = QtWidgets.QWidget()
+        preview_layout = QtWidgets.QVBoxLayout(preview_tab)
+        choose_folder_btn = QtWidgets.QPushButton("Choose Sample Folder")
+        choose_folder_btn.clicked.connect(self.choose_sample_folder)
+        preview_layout.addWidget(choose_folder_btn)
+
+        self.preview_status = QtWidgets.QLabel("No sample folder chosen")
+        self.preview_status.setWordWrap(True)
+        preview_layout.addWidget(self.preview_status)
+
+        self.preview_tree = QtWidgets.QTreeWidget()
+        self.preview_tree.setHeaderLabels(["Document / Entity", "Result", "Examples"])
+        preview_layout.addWidget(self.preview_tree)
+
+        sidebar_tabs.addTab(preview_tab, "Batch Preview")
+
         sidebar_layout.addWidget(sidebar_tabs)
         sidebar_layout.addStretch()
 
@@ -204,13 +232,12 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         if not ok or not document_name.strip():
             document_name = f"Document {len(self.documents) + 1}"
         new_document = {"document_name": document_name, "criteria_sets": [], "entities": []}
-        self.documents.append(new_document)
+        self.history.append(self.documents, (), new_document)
         self.document_list.addItem(new_document["document_name"])
         self.selected_document_index = len(self.documents) - 1
         self.selected_criteria_set_index = None
         self.selected_entity_index = None
         self.show_page()
-        self.push_undo_stack()
 
     def add_criteria(self):
         if self.selected_document_index is None:
@@ -235,13 +262,12 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         }
 
         # Add the criteria to the selected document
-        self.documents[self.selected_document_index]["criteria_sets"].append(new_criteria)
+        self.history.append(self.documents, (self.selected_document_index, "criteria_sets"), new_criteria)
         self.criteria_list.addItem(criteria_name)
         self.criteria_name_input.clear()
         self.selected_criteria_set_index = len(self.documents[self.selected_document_index]["criteria_sets"]) - 1
         self.selected_entity_index = None
         self.show_page()
-        self.push_undo_stack()
 
     def new_json(self):
         self.documents = []
@@ -251,21 +277,19 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.selected_document_index = None
         self.selected_criteria_set_index = None
         self.selected_entity_index = None
-        self.undo_stack.clear()
-        self.redo_stack.clear()
+        self.history.clear()
         self.show_page()
 
     def delete_document(self):
         selected_items = self.document_list.selectedItems()
         if selected_items:
             index = self.document_list.row(selected_items[0])
-            del self.documents[index]
+            self.history.delete(self.documents, (), index)
             self.document_list.takeItem(index)
             self.selected_document_index = None if not self.documents else 0
             self.selected_criteria_set_index = None
             self.selected_entity_index = None
             self.show_page()
-            self.push_undo_stack()
 
     def select_document(self, item):
         self.selected_document_index = self.document_list.row(item)
@@ -286,38 +310,55 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         file_path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Open PDF File", "", "PDF Files (*.pdf)")
         if file_path:
             self.pdf_document = fitz.open(file_path)
+            self.renderer.open(file_path, self.pdf_document)
             self.current_page_index = 0
             self.show_page()
 
     def show_page(self):
         if self.pdf_document is not None:
-            # Load the current page
-            page = self.pdf_document.load_page(self.current_page_index)
-
-            # Apply zoom transformation
-            mat = fitz.Matrix(self.zoom_level, self.zoom_level)
-            pix = page.get_pixmap(matrix=mat)
-
-            # Convert the pixmap to a QImage for display
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            img = img.convert("RGBA")
-            data = img.tobytes("raw", "RGBA")
-            q_image = QtGui.QImage(data, img.width, img.height, QtGui.QImage.Format.Format_RGBA8888)
-
-            # Update the viewer with the zoomed PDF page
-            pixmap = QtGui.QPixmap.fromImage(q_image)
-            self.viewer.setPixmap(pixmap)
-            self.viewer.adjustSize()
-
-            # Redraw rectangles for the selected document, criteria set, and its entities
-            if self.selected_document_index is not None:
-                document = self.documents[self.selected_document_index]
-                if self.selected_criteria_set_index is not None:
-                    criteria_set = document["criteria_sets"][self.selected_criteria_set_index]
-                    self.draw_rectangle(criteria_set["criteria_box"], color=QtCore.Qt.GlobalColor.blue, label=criteria_set.get("criteria", "Unnamed Criteria"))
-                for entity in document["entities"]:
-                    if "coordinates" in entity:
-                        self.draw_rectangle(entity["coordinates"], color=QtCore.Qt.GlobalColor.green, label=entity.get("name", "Unnamed Entity"))
+            # Show the best render available now (cached page or quick preview); the sharp page
+            # arrives in page_rendered. The boxes are separate items on top of it.
+            self.viewer.clear_tiles()
+            rendered = self.renderer.request(self.current_page_index, self.zoom_level)
+            if rendered is not None:
+                self.viewer.set_page(*rendered, zoom=self.zoom_level)
+            else:
+                self.viewer.set_zoom(self.zoom_level)
+            self.request_tiles()
+            self.viewer.set_hover(None)
+            self.draw_overlays()
+
+    def page_rendered(self, page_index, pixmap, pixmap_zoom):
+        # Swap in a background render of the current page; the boxes are in PDF points and stay put
+        if page_index == self.current_page_index:
+            self.viewer.set_page(pixmap, pixmap_zoom, zoom=self.zoom_level)
+
+    def request_tiles(self):
+        # Above the renderer's whole-page size only the tiles on screen are rendered at the full zoom
+        if self.pdf_document is None:
+            return
+        ready = self.renderer.request_tiles(self.current_page_index, self.zoom_level, self.viewer.visible_rect())
+        self.viewer.retain_tiles(self.renderer.wanted_tiles)
+        for key, pixmap in ready:
+            self.viewer.set_tile(key, pixmap)
+
+    def tile_rendered(self, key, pixmap):
+        if key[0] == self.current_page_index:
+            self.viewer.set_tile(key, pixmap)
+
+    def draw_overlays(self):
+        # Redraw rectangles for the selected document, criteria set, and its entities
+        self.viewer.clear_boxes()
+        if self.selected_document_index is not None:
+            document = self.documents[self.selected_document_index]
+            if self.selected_criteria_set_index is not None:
+                criteria_set = document["criteria_sets"][self.selected_criteria_set_index]
+                self.draw_rectangle(criteria_set["criteria_box"], color=QtCore.Qt.GlobalColor.blue, label=criteria_set.get("criteria", "Unnamed Criteria"),
+                                    key=("criteria", self.selected_criteria_set_index))
+            for entity_index, entity in enumerate(document["entities"]):
+                if "coordinates" in entity:
+                    self.draw_rectangle(entity["coordinates"], color=QtCore.Qt.GlobalColor.green, label=entity.get("name", "Unnamed Entity"),
+                                        key=("entity", entity_index))
 
     def save_json(self):
         file_path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save JSON File", "", "JSON Files (*.json)")
@@ -342,6 +383,7 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             self.selected_document_index = 0 if self.documents else None
             self.selected_criteria_set_index = None
             self.selected_entity_index = None
+            self.history.clear()  # Recorded edits refer to the previous template
             self.document_list.clear()
             for document in self.documents:
                 self.document_list.addItem(document.get("document_name", "Unnamed Document"))
@@ -377,82 +419,72 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.zoom_level = 1.0
         self.show_page()
 
-    def handle_wheel_event(self, event):
-        # Handle zoom with Ctrl + scroll
-        if event.modifiers() == QtCore.Qt.KeyboardModifier.ControlModifier:
-            if event.angleDelta().y() > 0:
-                self.zoom_in()
-            else:
-                self.zoom_out()
-
-    def start_draw_rectangle(self, event):
-        if event.button() == QtCore.Qt.MouseButton.RightButton:
+    def handle_wheel_event(self, direction):
+        # Zoom with Ctrl + scroll
+        if direction > 0:
+            self.zoom_in()
+        else:
+            self.zoom_out()
+
+    def drawn_box(self, position):
+        # The box from the press to position, grown to whole words so no character is cut off at an
+        # edge. Hold Alt to draw without snapping, or before the page's word index is ready.
+        word_index = None
+        if not QtWidgets.QApplication.keyboardModifiers() & QtCore.Qt.KeyboardModifier.AltModifier:
+            word_index = self.renderer.word_index(self.current_page_index)
+        return box_from_points(self.start_x, self.start_y, position.x(), position.y(), word_index)
+
+    def hover_word(self, position):
+        word_index = self.renderer.word_index(self.current_page_index) if self.pdf_document is not None else None
+        word = word_index.word_at(position.x(), position.y()) if word_index is not None else None
+        self.viewer.set_hover(word[:4] if word is not None else None)
+
+    def new_rubber_band(self):
+        # Dashed outline that follows the mouse while a rectangle is drawn
+        pen = QtGui.QPen(QtCore.Qt.GlobalColor.red, 1, QtCore.Qt.PenStyle.DashLine)
+        pen.setCosmetic(True)
+        return self.viewer.scene().addRect(QtCore.QRectF(self.start_x, self.start_y, 0, 0), pen)
+
+    def start_draw_rectangle(self, button, position):
+        # position is in PDF points; the view has already undone the zoom
+        if button == QtCore.Qt.MouseButton.RightButton:
             # Start editing the selected criteria
             if self.selected_document_index is not None and self.selected_criteria_set_index is not None:
-                self.start_x = int(event.position().x() / self.zoom_level)
-                self.start_y = int(event.position().y() / self.zoom_level)
+                self.start_x = position.x()
+                self.start_y = position.y()
 
                 # Initialize the rubber band rectangle for editing
-                self.rect = QtWidgets.QRubberBand(QtWidgets.QRubberBand.Shape.Rectangle, self.viewer)
-                self.rect.setGeometry(QtCore.QRect(
-                    int(self.start_x * self.zoom_level),
-                    int(self.start_y * self.zoom_level),
-                    0, 0
-                ))
-                self.rect.show()
-        elif event.button() == QtCore.Qt.MouseButton.LeftButton:
+                self.rect = self.new_rubber_band()
+        elif button == QtCore.Qt.MouseButton.LeftButton:
             # Start drawing a new rectangle
-            self.start_x = int(event.position().x() / self.zoom_level)
-            self.start_y = int(event.position().y() / self.zoom_level)
+            self.start_x = position.x()
+            self.start_y = position.y()
 
             # Initialize the rubber band rectangle
-            self.rect = QtWidgets.QRubberBand(QtWidgets.QRubberBand.Shape.Rectangle, self.viewer)
-            self.rect.setGeometry(QtCore.QRect(
-                int(self.start_x * self.zoom_level),
-                int(self.start_y * self.zoom_level),
-                0, 0
-            ))
-            self.rect.show()
-
-    def update_rectangle(self, event):
+            self.rect = self.new_rubber_band()
+
+    def update_rectangle(self, position):
         if self.rect is not None:
-            # Normalize current mouse coordinates to the PDF scale
-            current_x = int(event.position().x() / self.zoom_level)
-            current_y = int(event.position().y() / self.zoom_level)
-
-            # Update the rubber band geometry
-            self.rect.setGeometry(QtCore.QRect(
-                int(self.start_x * self.zoom_level),
-                int(self.start_y * self.zoom_level),
-                int((current_x - self.start_x) * self.zoom_level),
-                int((current_y - self.start_y) * self.zoom_level)
-            ))
-
-    def finish_rectangle(self, event):
+            # Update the rubber band geometry, showing the box as it will be snapped
+            box = self.drawn_box(position)
+            self.rect.setRect(QtCore.QRectF(box["x"], box["y"], box["width"], box["height"]))
+
+    def finish_rectangle(self, button, position):
         if self.rect is not None:
-            # Normalize ending coordinates to the PDF scale
-            end_x = int(event.position().x() / self.zoom_level)
-            end_y = int(event.position().y() / self.zoom_level)
+            box = self.drawn_box(position)
 
-            if event.button() == QtCore.Qt.MouseButton.RightButton:
+            if button == QtCore.Qt.MouseButton.RightButton:
                 # Edit the selected criteria with the new dimensions
                 if self.selected_document_index is not None and self.selected_criteria_set_index is not None:
-                    selected_document = self.documents[self.selected_document_index]
-                    criteria_set = selected_document['criteria_sets'][self.selected_criteria_set_index]
-                    criteria_set['criteria_box'] = {
-                        "x": self.start_x,
-                        "y": self.start_y,
-                        "width": end_x - self.start_x,
-                        "height": end_y - self.start_y
-                    }
+                    criteria_path = (self.selected_document_index, 'criteria_sets', self.selected_criteria_set_index)
+                    self.history.set(self.documents, criteria_path, 'criteria_box', box)
                     self.show_page()
-                    self.push_undo_stack()
-            elif event.button() == QtCore.Qt.MouseButton.LeftButton:
+            elif button == QtCore.Qt.MouseButton.LeftButton:
                 # Add a new entity with the drawn rectangle
                 if self.selected_document_index is None or self.selected_criteria_set_index is None:
-                    QtWidgets.QMessageBox.warning(self, "No Criteria Selected", "Please select a criteria set first.")
-                    self.rect.hide()
+                    self.viewer.scene().removeItem(self.rect)
                     self.rect = None
+                    QtWidgets.QMessageBox.warning(self, "No Criteria Selected", "Please select a criteria set first.")
                     return
 
                 # Get the selected document and criteria set
@@ -463,53 +495,36 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
                 new_entity = {
                     "name": f"Entity {len(selected_document['entities']) + 1}",
                     "text": "",
-                    "coordinates": {
-                        "x": self.start_x,
-                        "y": self.start_y,
-                        "width": end_x - self.start_x,
-                        "height": end_y - self.start_y
-                    }
+                    "coordinates": box
                 }
 
                 # Add the entity to the selected document
-                selected_document['entities'].append(new_entity)
+                self.history.append(self.documents, (self.selected_document_index, 'entities'), new_entity)
 
                 # Update the UI
                 self.entity_list.addItem(new_entity["name"])
                 self.update_entity_list(selected_document)
                 self.show_page()
-                self.push_undo_stack()
 
             # Reset the rectangle
-            self.rect.hide()
-            self.rect = None
+            if self.rect is not None:
+                self.viewer.scene().removeItem(self.rect)
+                self.rect = None
 
-    def draw_rectangle(self, rect_data, color=QtCore.Qt.GlobalColor.red, label=None):
-        pixmap = self.viewer.pixmap()
-        if pixmap is None:
-            return
+    def draw_rectangle(self, rect_data, color=QtCore.Qt.GlobalColor.red, label=None, key=None):
+        # Boxes with a key can be moved and resized on the page; see box_changed
+        # Rectangle coordinates are in PDF points, the view applies the zoom
+        self.viewer.add_box(key, rect_data, color, label=label, editable=key is not None)
 
-        # Apply zoom transformation to rectangle coordinates
-        # Use get() with default values to handle missing keys
-        scaled_x = rect_data.get("x", 0) * self.zoom_level
-        scaled_y = rect_data.get("y", 0) * self.zoom_level
-        scaled_width = rect_data.get("width", 0) * self.zoom_level
-        scaled_height = rect_data.get("height", 0) * self.zoom_level
-
-        painter = QtGui.QPainter(pixmap)
-        pen = QtGui.QPen(color, 2)
-        painter.setPen(pen)
-        painter.drawRect(int(scaled_x), int(scaled_y), int(scaled_width), int(scaled_height))
-
-        # Optionally draw a label above the rectangle
-        if label:
-            painter.setPen(QtGui.QPen(QtCore.Qt.GlobalColor.black))
-            painter.setFont(QtGui.QFont("Arial", 10))
-            painter.drawText(int(scaled_x), int(scaled_y - 5), label)
-
-        painter.end()
-        self.viewer.setPixmap(pixmap)
-        self.viewer.update()
+    def box_changed(self, key, rect_data):
+        # A criteria or entity box of the selected document was moved or resized on the page
+        if self.selected_document_index is None:
+            return
+        kind, index = key
+        if kind == "criteria":
+            self.history.set(self.documents, (self.selected_document_index, "criteria_sets", index), "criteria_box", rect_data)
+        else:
+            self.history.set(self.documents, (self.selected_document_index, "entities", index), "coordinates", rect_data)
 
     def add_entity(self):
         # Ensure a document is selected
@@ -541,7 +556,7 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
 
         # Append the new entity to the selected document
         selected_document = self.documents[self.selected_document_index]
-        selected_document['entities'].append(new_entity)
+        self.history.append(self.documents, (self.selected_document_index, 'entities'), new_entity)
 
         # Update the UI
         self.entity_list.addItem(entity_name)
@@ -549,17 +564,15 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.entity_text_input.clear()
         self.update_entity_list(selected_document)
         self.show_page()
-        self.push_undo_stack()  # Save the state for undo
 
     def set_entity_text(self):
         selected_items = self.entity_list.selectedItems()
         if selected_items:
             index = self.entity_list.row(selected_items[0])
-            self.documents[self.selected_document_index]['entities'][index]['text'] = self.entity_text_input.text()
+            self.history.set(self.documents, (self.selected_document_index, 'entities', index), 'text', self.entity_text_input.text())
             self.entity_list.item(index).setText(self.entity_name_input.text())
             self.entity_text_input.clear()
             self.show_page()
-            self.push_undo_stack()
 
     def remove_entity(self):
         selected_items = self.entity_list.selectedItems()
@@ -567,10 +580,9 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             entity_index = self.entity_list.row(selected_items[0])
             if self.selected_document_index is not None:
                 selected_document = self.documents[self.selected_document_index]
-                del selected_document['entities'][entity_index]
+                self.history.delete(self.documents, (self.selected_document_index, 'entities'), entity_index)
                 self.update_entity_list(selected_document)
                 self.show_page()
-                self.push_undo_stack()
 
     def delete_criteria(self):
         selected_items = self.criteria_list.selectedItems()
@@ -578,12 +590,11 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             for item in selected_items:
                 index = self.criteria_list.row(item)
                 if self.selected_document_index is not None:
-                    del self.documents[self.selected_document_index]['criteria_sets'][index]
+                    self.history.delete(self.documents, (self.selected_document_index, 'criteria_sets'), index)
                     self.criteria_list.takeItem(index)
             self.selected_criteria_set_index = None
             self.update_entity_list()
             self.show_page()  # Update to remove deleted rectangles
-            self.push_undo_stack()
 
     def set_criteria_box(self):
         if self.selected_document_index is not None and self.selected_criteria_set_index is not None:
@@ -591,17 +602,15 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             if len(criteria_box_values) == 4:
                 try:
                     x, y, width, height = map(int, criteria_box_values)
-                    selected_document = self.documents[self.selected_document_index]
-                    criteria_set = selected_document['criteria_sets'][self.selected_criteria_set_index]
-                    criteria_set['criteria_box'] = {
+                    criteria_path = (self.selected_document_index, 'criteria_sets', self.selected_criteria_set_index)
+                    self.history.set(self.documents, criteria_path, 'criteria_box', {
                         "x": x,
                         "y": y,
                         "width": width,
                         "height": height
-                    }
+                    })
                     self.criteria_box_input.clear()
                     self.show_page()
-                    self.push_undo_stack()
                 except ValueError:
                     QtWidgets.QMessageBox.warning(self, "Invalid Input", "Please enter valid integer values for coordinates.")
 
@@ -611,17 +620,15 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             if len(entity_coords_values) == 4:
                 try:
                     x, y, width, height = map(int, entity_coords_values)
-                    selected_document = self.documents[self.selected_document_index]
-                    entity = selected_document['entities'][self.selected_entity_index]
-                    entity['coordinates'] = {
+                    entity_path = (self.selected_document_index, 'entities', self.selected_entity_index)
+                    self.history.set(self.documents, entity_path, 'coordinates', {
                         "x": x,
                         "y": y,
                         "width": width,
                         "height": height
-                    }
+                    })
                     self.entity_coordinates_input.clear()
                     self.show_page()
-                    self.push_undo_stack()
                 except ValueError:
                     QtWidgets.QMessageBox.warning(self, "Invalid Input", "Please enter valid integer values for coordinates.")
 
@@ -630,16 +637,12 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         index = self.criteria_list.row(item)
         self.selected_criteria_set_index = index
 
-        # Refresh the viewer
+        # Refresh the viewer; it draws the selected criteria's box
         self.show_page()
 
         # Get the selected document and criteria set
         if self.selected_document_index is not None:
             document = self.documents[self.selected_document_index]
-            criteria_set = document["criteria_sets"][index]
-
-            # Draw the rectangle for the criteria using default values if necessary
-            self.draw_rectangle(criteria_set.get("criteria_box", {}), color=QtCore.Qt.GlobalColor.blue, label=criteria_set.get("criteria", "Unnamed Criteria"))
 
             # Update the entity list to reflect the selected criteria
             self.update_entity_list(document)
@@ -662,21 +665,19 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         selected_items = self.criteria_list.selectedItems()
         if selected_items:
             index = self.criteria_list.row(selected_items[0])
-            self.documents[self.selected_document_index]['criteria_sets'][index]['criteria'] = self.criteria_name_input.text()
+            self.history.set(self.documents, (self.selected_document_index, 'criteria_sets', index), 'criteria', self.criteria_name_input.text())
             self.criteria_list.item(index).setText(self.criteria_name_input.text())
             self.criteria_name_input.clear()
             self.show_page()
-            self.push_undo_stack()
 
     def set_entity_name(self):
         selected_items = self.entity_list.selectedItems()
         if selected_items:
             index = self.entity_list.row(selected_items[0])
-            self.documents[self.selected_document_index]['entities'][index]['name'] = self.entity_name_input.text()
+            self.history.set(self.documents, (self.selected_document_index, 'entities', index), 'name', self.entity_name_input.text())
             self.entity_list.item(index).setText(self.entity_name_input.text())
             self.entity_name_input.clear()
             self.show_page()
-            self.push_undo_stack()
 
     def preview_text(self):
         selected_items = self.entity_list.selectedItems()
@@ -704,31 +705,86 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
                 message += f"\nExpected Text: {expected_text}"
             QtWidgets.QMessageBox.information(self, "Extracted Text", message)
 
-    def push_undo_stack(self):
-        # Make a deep copy of annotations to push to the undo stack
-        self.undo_stack.append(json.loads(json.dumps(self.documents)))
-        self.redo_stack.clear()  # Clear the redo stack after a new action
-
     def undo_action(self):
-        if self.undo_stack:
-            self.redo_stack.append(json.loads(json.dumps(self.documents)))  # Save current state to redo stack
-            self.documents = self.undo_stack.pop()  # Restore the last saved state
+        if self.history.undo(self.documents):
             self.refresh_ui()
 
     def redo_action(self):
-        if self.redo_stack:
-            self.undo_stack.append(json.loads(json.dumps(self.documents)))  # Save current state to undo stack
-            self.documents = self.redo_stack.pop()  # Restore the state
+        if self.history.redo(self.documents):
             self.refresh_ui()
 
+    def choose_sample_folder(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, "Choose Sample Folder")
+        if directory:
+            self.batch_preview.set_folder(directory)
+            self.preview_version = None  # Run the whole template on the new folder
+            self.update_batch_preview()
+            self.preview_timer.start(250)
+
+    def update_batch_preview(self):
+        # Re-run only what the edits since the last tick changed, then show the files finished so far
+        changed = self.history.version != self.preview_version
+        if changed:
+            self.preview_version = self.history.version
+            self.batch_preview.update(self.documents)
+        if self.batch_preview.collect() or changed:
+            self.show_batch_preview()
+
+    def show_batch_preview(self):
+        summary = self.batch_preview.summary()
+        status = f"{summary['done']}/{summary['files']} files done"
+        if summary["running"]:
+            status += f", {summary['running']} running"
+        if summary["unmatched"]:
+            status += f"\n{len(summary['unmatched'])} matched by no document: {', '.join(summary['unmatched'][:5])}"
+            if len(summary["unmatched"]) > 5:
+                status += ", ..."
+        self.preview_status.setText(status)
+
+        self.preview_tree.clear()
+        for document in summary["documents"]:
+            result = f"{document['files_matched']}/{document['files_done']} files"
+            if document["files_done"]:
+                result += f" ({100 * document['files_matched'] / document['files_done']:.0f}%), {document['pages']} pages"
+            if document["errors"]:
+                result += f", {document['errors']} failed"
+            item = QtWidgets.QTreeWidgetItem([document["name"], result])
+            for entity in document["entities"]:
+                empty = f"{100 * entity['empty'] / entity['rows']:.0f}% empty" if entity["rows"] else "No matches"
+                item.addChild(QtWidgets.QTreeWidgetItem([entity["name"], empty, ", ".join(entity["examples"])]))
+            self.preview_tree.addTopLevelItem(item)
+            item.setExpanded(True)
+
+    def closeEvent(self, event):
+        self.preview_timer.stop()
+        self.batch_preview.shutdown()
+        # Drop queued renders and let the running one finish before the window's objects go away
+        self.renderer.pool.clear()
+        self.renderer.wait()
+        super().closeEvent(event)
+
     def refresh_ui(self):
         # Update UI elements with the new state of annotations
+        self.document_list.clear()
+        for document in self.documents:
+            self.document_list.addItem(document.get("document_name", "Unnamed Document"))
+        if self.selected_document_index is not None and self.selected_document_index >= len(self.documents):
+            # The selected document was removed again
+            self.selected_document_index = len(self.documents) - 1 if self.documents else None
         self.criteria_list.clear()
-        if self.selected_document_index is not None:
+        if self.selected_document_index is None:
+            self.selected_criteria_set_index = None
+            self.selected_entity_index = None
+        else:
             document = self.documents[self.selected_document_index]
             for criteria_set in document.get("criteria_sets", []):
                 self.criteria_list.addItem(criteria_set['criteria'])
-            if self.selected_criteria_set_index is not None and self.selected_criteria_set_index < len(document["criteria_sets"]):
+            # Drop selections the undo or redo removed
+            if self.selected_criteria_set_index is not None and self.selected_criteria_set_index >= len(document["criteria_sets"]):
+                self.selected_criteria_set_index = len(document["criteria_sets"]) - 1 if document["criteria_sets"] else None
+            if self.selected_entity_index is not None and self.selected_entity_index >= len(document["entities"]):
+                self.selected_entity_index = None
+            if self.selected_criteria_set_index is not None:
                 self.criteria_list.setCurrentRow(self.selected_criteria_set_index)
             self.update_entity_list(document)
         self.show_page()
@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import time
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from entityextractor import logger, setup_logging, load_plan, plan_columns, append_output, WorkerPool
+
+# Optional: native file system notifications (inotify on Linux); polling is used without it
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+class PdfEventHandler(FileSystemEventHandler):
+    def __init__(self, daemon):
+        super().__init__()
+        self.daemon = daemon
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.daemon.notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.daemon.notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.daemon.notify(event.dest_path)
+
+class ExtractionDaemon:
+    def __init__(self, watch_directories, criteria_files, output_files, max_workers=None,
+                 poll_interval=1.0, settle_time=2.0, process_existing=False, use_polling=False,
+                 max_pdfs_per_worker=None, max_worker_rss_mb=None, mupdf_store_mb=None, stats_interval=600.0,
+                 classify_only=False, state_file=None):
+        self.watch_directories = watch_directories
+        self.criteria_files = criteria_files
+        self.output_files = list(output_files)
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.use_polling = use_polling or Observer is None
+        self.max_pdfs_per_worker = max_pdfs_per_worker
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.mupdf_store_mb = mupdf_store_mb
+        self.stats_interval = stats_interval
+        self.classify_only = classify_only
+        self.last_stats = time.monotonic()
+        # Signatures of the files already processed, kept across restarts
+        self.state_file = state_file or f"{os.path.splitext(self.output_files[0])[0]}.processed.json"
+
+        self.pool = None
+        self.observer = None
+        self.columns = []
+        self.entity_types = []
+        self.criteria_mtimes = {}
+        self.pending = {}  # path -> (size, mtime, first time that signature was seen)
+        self.seen = {}  # path -> (size, mtime) already submitted
+        self.processed = {}  # path -> (size, mtime) whose results were written, saved to state_file
+        self.in_flight = {}  # future -> (path, (size, mtime), pool it was submitted to)
+        self.lock = threading.Lock()
+        self.stopping = False
+
+        if os.path.exists(self.state_file):
+            # A restart: everything not processed before, including files dropped while the daemon
+            # was down, is processed now, whatever process_existing says
+            self.processed = self.load_state()
+            self.seen = dict(self.processed)
+        elif not process_existing:
+            # First run: files already sitting in the drop folders are treated as processed
+            for pdf_path in self.list_pdfs():
+                signature = self.file_signature(pdf_path)
+                if signature is not None:
+                    self.seen[pdf_path] = signature
+            self.processed = dict(self.seen)
+            self.save_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r') as file:
+                state = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable state file '{self.state_file}': {e}")
+            return {}
+        # Files removed from the drop folders since are forgotten, so the state does not grow forever
+        return {pdf_path: tuple(signature) for pdf_path, signature in state.items() if os.path.exists(pdf_path)}
+
+    def save_state(self):
+        # Written to a temporary file and swapped in, so a crash mid-write keeps the previous state
+        partial = f"{self.state_file}.part"
+        try:
+            with open(partial, 'w') as file:
+                json.dump(self.processed, file)
+            os.replace(partial, self.state_file)
+        except OSError as e:
+            logger.error(f"Error saving state file '{self.state_file}': {e}")
+
+    def list_pdfs(self):
+        for directory in self.watch_directories:
+            try:
+                for file_name in os.listdir(directory):
+                    if file_name.lower().endswith('.pdf'):
+                        yield os.path.join(directory, file_name)
+            except OSError as e:
+                logger.error(f"Error listing '{directory}': {e}")
+
+    def file_signature(self, pdf_path):
+        try:
+            stat = os.stat(pdf_path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def notify(self, pdf_path):
+        if pdf_path.lower().endswith('.pdf'):
+            with self.lock:
+                self.pending.setdefault(pdf_path, None)
+
+    def load_plans(self):
+        # Compile in the parent first so a broken criteria file never replaces the working pool
+        plans = [load_plan(criteria_file, self.classify_only) for criteria_file in self.criteria_files]
+        self.columns = [plan_columns(plan) for plan in plans]
+        self.entity_types = [plan["entity_types"] for plan in plans]
+        self.criteria_mtimes = {criteria_file: os.path.getmtime(criteria_file) for criteria_file in self.criteria_files}
+
+        old_pool = self.pool
+        # Workers compile the plans once in their initializer and stay warm between files
+        self.pool = WorkerPool(
+            self.criteria_files,
+            max_workers=self.max_workers,
+            max_pdfs_per_worker=self.max_pdfs_per_worker,
+            max_worker_rss_mb=self.max_worker_rss_mb,
+            mupdf_store_mb=self.mupdf_store_mb,
+            classify_only=self.classify_only
+        )
+        if old_pool is not None:
+            # Files already handed to the old workers finish with the old plans
+            old_pool.shutdown(wait=False)
+        logger.info(f"Loaded criteria from {', '.join(self.criteria_files)}")
+
+    def reload_plans_if_changed(self):
+        try:
+            changed = any(os.path.getmtime(criteria_file) != mtime for criteria_file, mtime in self.criteria_mtimes.items())
+        except OSError as e:
+            logger.error(f"Error checking criteria files: {e}")
+            return
+        if not changed:
+            return
+        try:
+            self.load_plans()
+        except Exception as e:
+            logger.error(f"Error reloading criteria, keeping the previous plans: {e}")
+            # Do not retry the same broken file on every tick
+            self.criteria_mtimes = {criteria_file: os.path.getmtime(criteria_file) for criteria_file in self.criteria_files}
+
+    def submit_settled(self):
+        now = time.monotonic()
+        if self.use_polling:
+            for pdf_path in self.list_pdfs():
+                if self.seen.get(pdf_path) != self.file_signature(pdf_path):
+                    self.notify(pdf_path)
+
+        with self.lock:
+            pending = list(self.pending.items())
+
+        for pdf_path, last in pending:
+            signature = self.file_signature(pdf_path)
+            if signature is None:
+                with self.lock:
+                    self.pending.pop(pdf_path, None)
+                continue
+            if self.seen.get(pdf_path) == signature:
+                with self.lock:
+                    self.pending.pop(pdf_path, None)
+                continue
+            if last is None or last[:2] != signature:
+                # Size or mtime still changing, the file is being copied in
+                with self.lock:
+                    self.pending[pdf_path] = signature + (now,)
+                continue
+            if now - last[2] < self.settle_time:
+                continue
+
+            with self.lock:
+                self.pending.pop(pdf_path, None)
+            self.seen[pdf_path] = signature
+            self.in_flight[self.pool.submit(pdf_path)] = (pdf_path, signature, self.pool)
+            logger.info(f"Queued {os.path.basename(pdf_path)}")
+
+    def collect_finished(self):
+        finished = [future for future in self.in_flight if future.done()]
+        for future in finished:
+            pdf_path, signature, pool = self.in_flight.pop(future)
+            try:
+                results = future.result()
+            except BrokenProcessPool as e:
+                if pool is not self.pool and self.pool is not None and not self.stopping:
+                    # Caught in a crash on the pool retired by a criteria reload, which starts no new
+                    # workers; run it again on the current pool
+                    self.in_flight[self.pool.submit(pdf_path)] = (pdf_path, signature, self.pool)
+                    continue
+                logger.error(f"Error processing {pdf_path}: {e}")
+                continue
+            except Exception as e:
+                # Not recorded as processed, so it is tried again after a restart
+                logger.error(f"Error processing {pdf_path}: {e}")
+                continue
+
+            for index, pdf_data in enumerate(results):
+                if not pdf_data:
+                    continue
+                try:
+                    self.output_files[index] = append_output(pdf_data, self.output_files[index], self.columns[index], self.entity_types[index])
+                except Exception as e:
+                    logger.error(f"Error writing results of {pdf_path} to '{self.output_files[index]}': {e}")
+            logger.info(f"Processed {os.path.basename(pdf_path)}: {sum(len(pdf_data) for pdf_data in results)} matches")
+            self.processed[pdf_path] = signature
+        if finished:
+            self.save_state()
+
+    def start_observer(self):
+        if self.use_polling:
+            logger.info(f"Polling {', '.join(self.watch_directories)} every {self.poll_interval}s")
+            return
+        self.observer = Observer()
+        handler = PdfEventHandler(self)
+        for directory in self.watch_directories:
+            self.observer.schedule(handler, directory, recursive=False)
+        self.observer.start()
+        logger.info(f"Watching {', '.join(self.watch_directories)} for new PDFs")
+
+    def run(self):
+        self.load_plans()
+        self.start_observer()
+        if not self.use_polling:
+            # Pick up anything that arrived before the observer was running
+            for pdf_path in self.list_pdfs():
+                if pdf_path not in self.seen:
+                    self.notify(pdf_path)
+
+        try:
+            while not self.stopping:
+                self.reload_plans_if_changed()
+                self.submit_settled()
+                self.collect_finished()
+                if time.monotonic() - self.last_stats >= self.stats_interval:
+                    # Periodic per-worker RSS report, to spot growth in multi-day runs
+                    self.pool.log_worker_stats()
+                    self.last_stats = time.monotonic()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Stopping extraction daemon...")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopping = True
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.collect_finished()
+            self.pool.log_worker_stats()
+            self.pool = None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Watch drop folders and extract entities from new PDFs as they arrive.")
+    parser.add_argument("--watch", nargs="+", required=True, help="Directories to watch for new PDF files")
+    parser.add_argument("--criteria", nargs="+", required=True)
+    parser.add_argument("--output", nargs="+", required=True, help="CSV files the results are appended to, one per criteria file")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between folder scans and result collection")
+    parser.add_argument("--settle-time", type=float, default=2.0, help="Seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--process-existing", action="store_true", help="On the first run, also process PDFs already in the folders")
+    parser.add_argument("--state-file", default=None, help="Where processed files are recorded across restarts (default: next to the first output)")
+    parser.add_argument("--polling", action="store_true", help="Poll the folders even if watchdog is installed")
+    # Memory bounds for long runs
+    parser.add_argument("--max-pdfs-per-worker", type=int, default=None)
+    parser.add_argument("--max-worker-rss-mb", type=float, default=None)
+    parser.add_argument("--mupdf-store-mb", type=float, default=None, help="Trim the MuPDF store to this size after each file (0 empties it)")
+    parser.add_argument("--classify-only", action="store_true", help="Only output PDF_File, NumPages, Page and Document")
+    parser.add_argument("--stats-interval", type=float, default=600.0, help="Seconds between per-worker RSS reports")
+    args = parser.parse_args(argv)
+
+    if len(args.criteria) != len(args.output):
+        parser.error("--criteria and --output must be given the same number of files")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    daemon = ExtractionDaemon(
+        args.watch, args.criteria, args.output,
+        max_workers=args.workers,
+        poll_interval=args.poll_interval,
+        settle_time=args.settle_time,
+        process_existing=args.process_existing,
+        use_polling=args.polling,
+        max_pdfs_per_worker=args.max_pdfs_per_worker,
+        max_worker_rss_mb=args.max_worker_rss_mb,
+        mupdf_store_mb=args.mupdf_store_mb,
+        stats_interval=args.stats_interval,
+        classify_only=args.classify_only,
+        state_file=args.state_file
+    )
+    daemon.run()
+
+if __name__ == "__main__":
+    main()
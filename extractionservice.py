@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from entityextractor import logger, setup_logging, load_plan, WorkerPool
+
+class ExtractionService(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, criteria_files, max_workers=None, max_concurrent=4, queue_timeout=30.0, max_upload_mb=200,
+                 max_pdfs_per_worker=None, max_worker_rss_mb=None, mupdf_store_mb=None):
+        super().__init__(address, ExtractionRequestHandler)
+        # Compile once in the parent so a broken criteria file fails at startup, not on the first request
+        for criteria_file in criteria_files:
+            load_plan(criteria_file)
+        self.criteria_files = criteria_files
+        # Workers compile the plans once in their initializer and stay warm between requests; a worker
+        # that dies is replaced by the pool instead of failing every later request
+        self.pool = WorkerPool(criteria_files, max_workers=max_workers, max_pdfs_per_worker=max_pdfs_per_worker,
+                               max_worker_rss_mb=max_worker_rss_mb, mupdf_store_mb=mupdf_store_mb)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.queue_timeout = queue_timeout
+        self.max_upload_bytes = int(max_upload_mb * 1024 * 1024)
+
+    def extract(self, pdf_path, stream=None):
+        # Raises ValueError when the file is not a readable PDF
+        results = self.pool.submit(pdf_path, stream, strict=True).result()
+        return [
+            {"criteria_file": criteria_file, "rows": rows}
+            for criteria_file, rows in zip(self.criteria_files, results)
+        ]
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+class ExtractionRequestHandler(BaseHTTPRequestHandler):
+    # GET  /health                                    -> {"status": "ok"}
+    # POST /extract {"path": "..."}                  -> rows for a PDF readable by the service
+    # POST /extract?name=file.pdf  (application/pdf) -> rows for the uploaded PDF bytes
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self.send_json(200, {"status": "ok", "criteria_files": self.server.criteria_files})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        started = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != "/extract":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        # The slot is taken before the body is read, so max_concurrent also bounds the uploads held in memory
+        if not self.server.slots.acquire(timeout=self.server.queue_timeout):
+            self.send_json(503, {"error": "Too many concurrent requests"})
+            return
+        pdf_path = None
+        try:
+            try:
+                pdf_path, stream = self.read_request(url)
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            try:
+                results = self.server.extract(pdf_path, stream)
+            except ValueError as e:
+                # Not a readable PDF (the worker has logged why): a bad input, not "no matches"
+                self.send_json(422, {"error": str(e)})
+                return
+        except Exception as e:
+            logger.error(f"Error processing {pdf_path or 'request'}: {e}")
+            self.send_json(500, {"error": str(e)})
+            return
+        finally:
+            self.server.slots.release()
+
+        latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(f"Extracted {os.path.basename(pdf_path)} in {latency_ms} ms")
+        self.send_json(200, {"pdf_file": os.path.basename(pdf_path), "results": results, "latency_ms": latency_ms},
+                       headers={"X-Response-Time-Ms": str(latency_ms)})
+
+    def read_request(self, url):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.server.max_upload_bytes:
+            raise ValueError("Request body too large")
+        body = self.rfile.read(length)
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip()
+
+        if content_type == "application/json":
+            try:
+                pdf_path = json.loads(body or b"{}").get("path")
+            except (json.JSONDecodeError, AttributeError):
+                raise ValueError("Body must be a JSON object")
+            if not pdf_path:
+                raise ValueError("Missing 'path'")
+            if not os.path.isfile(pdf_path):
+                raise ValueError(f"File not found: {pdf_path}")
+            return pdf_path, None
+
+        if not body:
+            raise ValueError("Empty upload")
+        # PDF_File is taken from ?name= so file-name based columns keep working for uploads
+        pdf_name = parse_qs(url.query).get("name", ["upload.pdf"])[0]
+        return os.path.basename(pdf_name), body
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve entity extraction for single PDFs over local HTTP.")
+    parser.add_argument("--criteria", nargs="+", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-concurrent", type=int, default=4, help="Requests processed at once; others wait for a slot")
+    parser.add_argument("--queue-timeout", type=float, default=30.0, help="Seconds a request waits for a slot before a 503")
+    parser.add_argument("--max-upload-mb", type=float, default=200)
+    parser.add_argument("--max-pdfs-per-worker", type=int, default=None)
+    parser.add_argument("--max-worker-rss-mb", type=float, default=None)
+    parser.add_argument("--mupdf-store-mb", type=float, default=None, help="Trim the MuPDF store to this size after each file (0 empties it)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    server = ExtractionService(
+        (args.host, args.port), args.criteria,
+        max_workers=args.workers,
+        max_concurrent=args.max_concurrent,
+        queue_timeout=args.queue_timeout,
+        max_upload_mb=args.max_upload_mb,
+        max_pdfs_per_worker=args.max_pdfs_per_worker,
+        max_worker_rss_mb=args.max_worker_rss_mb,
+        mupdf_store_mb=args.mupdf_store_mb
+    )
+    logger.info(f"Extraction service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping extraction service...")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
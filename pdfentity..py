@@ -1,9 +1,11 @@
 from PyQt6 import QtWidgets, QtGui, QtCore
 import fitz  # PyMuPDF
-from PIL import Image
 import json
 import sys
 
+from edithistory import EditHistory
+from pdfviewer import PageRenderer, PageView, box_from_points
+
 class PDFAnnotationTool(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
@@ -21,9 +23,13 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.rectangles = []  # Store drawn rectangles
         self.selected_criteria_index = None
 
-        # Undo/Redo Stacks
-        self.undo_stack = []
-        self.redo_stack = []
+        # Undo/Redo: each edit keeps only the change, for the last 500 edits
+        self.history = EditHistory(max_depth=500)
+
+        # Renders pages in the background and caches them by (page, zoom), capped in memory
+        self.renderer = PageRenderer(max_mb=256, parent=self)
+        self.renderer.rendered.connect(self.page_rendered)
+        self.renderer.tile_rendered.connect(self.tile_rendered)
 
         # UI Setup
         self.setup_ui()
@@ -73,18 +79,16 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         toolbar_layout.addWidget(zoom_out_btn)
         # Viewer Area
         viewer_layout.setContentsMargins(15, 15, 15, 15)
-        self.viewer = QtWidgets.QLabel(self)
-        self.viewer.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop | QtCore.Qt.AlignmentFlag.AlignLeft)
-        self.viewer.setMouseTracking(True)
-        self.viewer.mousePressEvent = self.start_draw_rectangle
-        self.viewer.mouseMoveEvent = self.update_rectangle
-        self.viewer.mouseReleaseEvent = self.finish_rectangle
-        self.viewer.wheelEvent = self.handle_wheel_event  # Add mouse wheel event for zoom in and out
-        viewer_scroll_area = QtWidgets.QScrollArea()
-        viewer_scroll_area.setWidgetResizable(True)
-        viewer_scroll_area.setWidget(self.viewer)
-        viewer_scroll_area.setStyleSheet("border: 2px solid #ccc; background-color: #f0f0f0;")
-        viewer_layout.addWidget(viewer_scroll_area)
+        self.viewer = PageView(self)
+        self.viewer.pressed.connect(self.start_draw_rectangle)
+        self.viewer.moved.connect(self.update_rectangle)
+        self.viewer.released.connect(self.finish_rectangle)
+        self.viewer.zoom_requested.connect(self.handle_wheel_event)  # Ctrl + mouse wheel zooms in and out
+        self.viewer.box_changed.connect(self.box_changed)  # Boxes moved or resized on the page
+        self.viewer.viewport_changed.connect(self.request_tiles)  # Sharp tiles for what is on screen at high zoom
+        self.viewer.hovered.connect(self.hover_word)  # Highlight the word under the cursor
+        self.viewer.setStyleSheet("border: 2px solid #ccc; background-color: #f0f0f0;")
+        viewer_layout.addWidget(self.viewer)
 
         # Sidebar for Criteria and Entities Management
         sidebar_layout.setContentsMargins(10, 10, 10, 10)
@@ -167,36 +171,29 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.criteria_list.clear()
         self.entity_list.clear()
         self.selected_criteria_index = None
-        self.undo_stack.clear()
-        self.redo_stack.clear()
+        self.history.clear()
         self.show_page()
 
     def open_pdf(self):
         file_path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Open PDF File", "", "PDF Files (*.pdf)")
         if file_path:
             self.pdf_document = fitz.open(file_path)
+            self.renderer.open(file_path, self.pdf_document)
             self.current_page_index = 0
             self.show_page()
 
     def show_page(self):
         if self.pdf_document is not None:
-            page = self.pdf_document.load_page(self.current_page_index)
-            mat = fitz.Matrix(self.zoom_level, self.zoom_level)
-            pix = page.get_pixmap(matrix=mat)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            img = img.convert("RGBA")
-            data = img.tobytes("raw", "RGBA")
-            q_image = QtGui.QImage(data, img.width, img.height, QtGui.QImage.Format.Format_RGBA8888)
-            pixmap = QtGui.QPixmap.fromImage(q_image)
-            self.viewer.setPixmap(pixmap)
-            self.viewer.adjustSize()
-
-            # Draw existing rectangles for the selected criteria
-            if self.selected_criteria_index is not None:
-                criteria = self.annotations[self.selected_criteria_index]
-                self.draw_rectangle(criteria['criteria_box'], color=QtCore.Qt.GlobalColor.blue, label=criteria['criteria'])
-                for entity in criteria['entities']:
-                    self.draw_rectangle(entity['coordinates'], color=QtCore.Qt.GlobalColor.green, label=entity['name'])
+            # Best render available now (cached page or quick preview); the sharp page arrives in page_rendered
+            self.viewer.clear_tiles()
+            rendered = self.renderer.request(self.current_page_index, self.zoom_level)
+            if rendered is not None:
+                self.viewer.set_page(*rendered, zoom=self.zoom_level)
+            else:
+                self.viewer.set_zoom(self.zoom_level)
+            self.request_tiles()
+            self.viewer.set_hover(None)
+            self.draw_overlays()
 
             # Ensure a criteria is always selected if available
             if self.annotations and self.selected_criteria_index is None:
@@ -204,6 +201,34 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
                 self.criteria_list.setCurrentRow(self.selected_criteria_index)
                 self.highlight_criteria(self.criteria_list.item(self.selected_criteria_index))
 
+    def page_rendered(self, page_index, pixmap, pixmap_zoom):
+        if page_index == self.current_page_index:
+            self.viewer.set_page(pixmap, pixmap_zoom, zoom=self.zoom_level)
+
+    def request_tiles(self):
+        # Above the renderer's whole-page size only the tiles on screen are rendered at the full zoom
+        if self.pdf_document is None:
+            return
+        ready = self.renderer.request_tiles(self.current_page_index, self.zoom_level, self.viewer.visible_rect())
+        self.viewer.retain_tiles(self.renderer.wanted_tiles)
+        for key, pixmap in ready:
+            self.viewer.set_tile(key, pixmap)
+
+    def tile_rendered(self, key, pixmap):
+        if key[0] == self.current_page_index:
+            self.viewer.set_tile(key, pixmap)
+
+    def draw_overlays(self):
+        # Draw existing rectangles for the selected criteria
+        self.viewer.clear_boxes()
+        if self.selected_criteria_index is not None:
+            criteria = self.annotations[self.selected_criteria_index]
+            self.draw_rectangle(criteria['criteria_box'], color=QtCore.Qt.GlobalColor.blue, label=criteria['criteria'],
+                                key=("criteria", self.selected_criteria_index))
+            for entity_index, entity in enumerate(criteria['entities']):
+                self.draw_rectangle(entity['coordinates'], color=QtCore.Qt.GlobalColor.green, label=entity['name'],
+                                    key=("entity", self.selected_criteria_index, entity_index))
+
     def save_json(self):
         file_path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save JSON File", "", "JSON Files (*.json)")
         if file_path:
@@ -215,6 +240,7 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         if file_path:
             with open(file_path, 'r') as json_file:
                 self.annotations = json.load(json_file)
+            self.history.clear()  # Recorded edits refer to the previous annotations
             self.selected_criteria_index = 0 if self.annotations else None
             self.criteria_list.clear()
             for annotation in self.annotations:
@@ -258,38 +284,44 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.zoom_level = 1.0
         self.show_page()
 
-    def handle_wheel_event(self, event):
-        # Handle zoom with Ctrl + scroll
-        if event.modifiers() == QtCore.Qt.KeyboardModifier.ControlModifier:
-            if event.angleDelta().y() > 0:
-                self.zoom_in()
-            else:
-                self.zoom_out()
-    def start_draw_rectangle(self, event):
-        self.start_x = int(event.position().x() / self.zoom_level)
-        self.start_y = int(event.position().y() / self.zoom_level)
-        self.rect = QtWidgets.QRubberBand(QtWidgets.QRubberBand.Shape.Rectangle, self.viewer)
-        self.rect.setGeometry(QtCore.QRect(int(self.start_x * self.zoom_level), int(self.start_y * self.zoom_level), 0, 0))
-        self.rect.show()
-
-    def update_rectangle(self, event):
+    def handle_wheel_event(self, direction):
+        # Zoom with Ctrl + scroll
+        if direction > 0:
+            self.zoom_in()
+        else:
+            self.zoom_out()
+    def drawn_box(self, position):
+        # The box from the press to position, grown to whole words so no character is cut off at an
+        # edge. Hold Alt to draw without snapping, or before the page's word index is ready.
+        word_index = None
+        if not QtWidgets.QApplication.keyboardModifiers() & QtCore.Qt.KeyboardModifier.AltModifier:
+            word_index = self.renderer.word_index(self.current_page_index)
+        return box_from_points(self.start_x, self.start_y, position.x(), position.y(), word_index)
+
+    def hover_word(self, position):
+        word_index = self.renderer.word_index(self.current_page_index) if self.pdf_document is not None else None
+        word = word_index.word_at(position.x(), position.y()) if word_index is not None else None
+        self.viewer.set_hover(word[:4] if word is not None else None)
+
+    def start_draw_rectangle(self, button, position):
+        # position is in PDF points; the view has already undone the zoom
+        self.start_x = position.x()
+        self.start_y = position.y()
+        pen = QtGui.QPen(QtCore.Qt.GlobalColor.red, 1, QtCore.Qt.PenStyle.DashLine)
+        pen.setCosmetic(True)
+        self.rect = self.viewer.scene().addRect(QtCore.QRectF(self.start_x, self.start_y, 0, 0), pen)
+
+    def update_rectangle(self, position):
         if self.rect is not None:
-            current_x = int(event.position().x() / self.zoom_level)
-            current_y = int(event.position().y() / self.zoom_level)
-            self.rect.setGeometry(QtCore.QRect(int(self.start_x * self.zoom_level), int(self.start_y * self.zoom_level), int((current_x - self.start_x) * self.zoom_level), int((current_y - self.start_y) * self.zoom_level)))
+            # Shown as it will be snapped
+            box = self.drawn_box(position)
+            self.rect.setRect(QtCore.QRectF(box["x"], box["y"], box["width"], box["height"]))
 
-    def finish_rectangle(self, event):
+    def finish_rectangle(self, button, position):
         if self.rect is not None:
-            end_x = int(event.position().x() / self.zoom_level)
-            end_y = int(event.position().y() / self.zoom_level)
             new_criteria = {
                 "name": f"Entity {len(self.annotations[0]['entities']) + 1 if self.annotations else 1}",
-                "coordinates": {
-                    "x": self.start_x,
-                    "y": self.start_y,
-                    "width": end_x - self.start_x,
-                    "height": end_y - self.start_y
-                }
+                "coordinates": self.drawn_box(position)
             }
             if not self.annotations:  # If no criteria exist for the page, add a new one
                 annotation = {
@@ -297,32 +329,26 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
                     "criteria_box": new_criteria["coordinates"],
                     "entities": []
                 }
-                self.annotations.append(annotation)
+                self.history.append(self.annotations, (), annotation)
                 self.criteria_list.addItem(f"Criteria 1")
                 self.selected_criteria_index = 0
                 self.update_entity_list()
             else:  # If a criteria already exists, add the rectangle as an entity to the existing criteria
-                self.annotations[0]['entities'].append(new_criteria)
-            self.rect.hide()
+                self.history.append(self.annotations, (0, 'entities'), new_criteria)
+            self.viewer.scene().removeItem(self.rect)
             self.rect = None
             self.show_page()  # Redraw to maintain rectangles
-            self.push_undo_stack()
 
-    def draw_rectangle(self, rect_data, color=QtCore.Qt.GlobalColor.red, label=None):
-        pixmap = self.viewer.pixmap()
-        if pixmap is None:
-            return
-        painter = QtGui.QPainter(pixmap)
-        pen = QtGui.QPen(color, 2)
-        painter.setPen(pen)
-        painter.drawRect(int(rect_data["x"] * self.zoom_level), int(rect_data["y"] * self.zoom_level), int(rect_data["width"] * self.zoom_level), int(rect_data["height"] * self.zoom_level))
-        if label:
-            painter.setPen(QtGui.QPen(QtCore.Qt.GlobalColor.black))
-            painter.setFont(QtGui.QFont("Arial", 10))
-            painter.drawText(int(rect_data["x"] * self.zoom_level), int((rect_data["y"] * self.zoom_level) - 5), label)
-        painter.end()
-        self.viewer.setPixmap(pixmap)
-        self.viewer.update()
+    def draw_rectangle(self, rect_data, color=QtCore.Qt.GlobalColor.red, label=None, key=None):
+        # Boxes with a key can be moved and resized on the page; see box_changed
+        self.viewer.add_box(key, rect_data, color, label=label, editable=key is not None)
+
+    def box_changed(self, key, rect_data):
+        # A criteria or entity box was moved or resized on the page
+        if key[0] == "criteria":
+            self.history.set(self.annotations, (key[1],), 'criteria_box', rect_data)
+        else:
+            self.history.set(self.annotations, (key[1], 'entities', key[2]), 'coordinates', rect_data)
 
     def add_criteria(self):
         criteria_name = self.criteria_name_input.text() or f"Criteria {len(self.annotations) + 1}"
@@ -336,14 +362,13 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             },
             "entities": []
         }
-        self.annotations.append(new_criteria)
+        self.history.append(self.annotations, (), new_criteria)
         self.criteria_list.addItem(new_criteria['criteria'])
         self.criteria_name_input.clear()
         self.selected_criteria_index = len(self.annotations) - 1
         self.criteria_list.setCurrentRow(self.selected_criteria_index)
         self.update_entity_list(self.annotations[self.selected_criteria_index])
         self.show_page()
-        self.push_undo_stack()
     def add_entity(self):
         selected_items = self.criteria_list.selectedItems()
         if selected_items:
@@ -359,12 +384,11 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
                     "height": 100
                 }
             }
-            criteria['entities'].append(new_entity)
+            self.history.append(self.annotations, (index, 'entities'), new_entity)
             self.entity_list.addItem(new_entity['name'])
             self.entity_name_input.clear()
             self.update_entity_list(criteria)
             self.show_page()
-            self.push_undo_stack()
 
     def remove_entity(self):
         selected_items = self.entity_list.selectedItems()
@@ -372,28 +396,27 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         if selected_items and criteria_items:
             entity_index = self.entity_list.row(selected_items[0])
             criteria_index = self.criteria_list.row(criteria_items[0])
-            del self.annotations[criteria_index]['entities'][entity_index]
+            self.history.delete(self.annotations, (criteria_index, 'entities'), entity_index)
             self.update_entity_list(self.annotations[criteria_index])
             self.show_page()
-            self.push_undo_stack()
 
     def delete_criteria(self):
         selected_items = self.criteria_list.selectedItems()
         if selected_items:
             for item in selected_items:
                 index = self.criteria_list.row(item)
-                del self.annotations[index]
+                self.history.delete(self.annotations, (), index)
                 self.criteria_list.takeItem(index)
             self.selected_criteria_index = 0 if self.annotations else None
             self.update_entity_list()
             self.show_page()  # Update to remove deleted rectangles
-            self.push_undo_stack()
 
     def highlight_criteria(self, item):
         index = self.criteria_list.row(item)
         self.selected_criteria_index = index
         criteria = self.annotations[index]
         rect_data = criteria["criteria_box"]
+        self.draw_overlays()
         self.draw_highlighted_rectangle(rect_data)
         # Highlight entities within the criteria
         for entity in criteria['entities']:
@@ -401,16 +424,8 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         self.update_entity_list(criteria)
 
     def draw_highlighted_rectangle(self, rect_data, color=QtCore.Qt.GlobalColor.blue):
-        pixmap = self.viewer.pixmap()
-        if pixmap is None:
-            return
-        painter = QtGui.QPainter(pixmap)
-        pen = QtGui.QPen(color, 2, QtCore.Qt.PenStyle.DotLine)
-        painter.setPen(pen)
-        painter.drawRect(int(rect_data["x"] * self.zoom_level), int(rect_data["y"] * self.zoom_level), int(rect_data["width"] * self.zoom_level), int(rect_data["height"] * self.zoom_level))
-        painter.end()
-        self.viewer.setPixmap(pixmap)
-        self.viewer.update()
+        # Highlight only; presses go through to the editable boxes underneath
+        self.viewer.add_box(None, rect_data, color, dashed=True, editable=False)
 
     def update_entity_list(self, criteria=None):
         self.entity_list.clear()
@@ -422,11 +437,10 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         selected_items = self.criteria_list.selectedItems()
         if selected_items:
             index = self.criteria_list.row(selected_items[0])
-            self.annotations[index]['criteria'] = self.criteria_name_input.text()
+            self.history.set(self.annotations, (index,), 'criteria', self.criteria_name_input.text())
             self.criteria_list.item(index).setText(self.criteria_name_input.text())
             self.criteria_name_input.clear()
             self.show_page()
-            self.push_undo_stack()
 
     def set_entity_name(self):
         selected_items = self.entity_list.selectedItems()
@@ -434,11 +448,10 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
         if selected_items and criteria_items:
             entity_index = self.entity_list.row(selected_items[0])
             criteria_index = self.criteria_list.row(criteria_items[0])
-            self.annotations[criteria_index]['entities'][entity_index]['name'] = self.entity_name_input.text()
+            self.history.set(self.annotations, (criteria_index, 'entities', entity_index), 'name', self.entity_name_input.text())
             self.entity_list.item(entity_index).setText(self.entity_name_input.text())
             self.entity_name_input.clear()
             self.show_page()
-            self.push_undo_stack()
     def preview_text(self):
         selected_items = self.entity_list.selectedItems()
         criteria_items = self.criteria_list.selectedItems()
@@ -463,29 +476,29 @@ class PDFAnnotationTool(QtWidgets.QMainWindow):
             # Show the extracted text in a message box
             QtWidgets.QMessageBox.information(self, "Extracted Text", extracted_text if extracted_text else "No text found in the selected area.")
 
-    def push_undo_stack(self):
-        # Make a deep copy of annotations to push to the undo stack
-        self.undo_stack.append(json.loads(json.dumps(self.annotations)))
-        self.redo_stack.clear()  # Clear the redo stack after a new action
-
     def undo_action(self):
-        if self.undo_stack:
-            self.redo_stack.append(json.loads(json.dumps(self.annotations)))  # Save current state to redo stack
-            self.annotations = self.undo_stack.pop()  # Restore the last saved state
+        if self.history.undo(self.annotations):
             self.refresh_ui()
 
     def redo_action(self):
-        if self.redo_stack:
-            self.undo_stack.append(json.loads(json.dumps(self.annotations)))  # Save current state to undo stack
-            self.annotations = self.redo_stack.pop()  # Restore the state
+        if self.history.redo(self.annotations):
             self.refresh_ui()
 
+    def closeEvent(self, event):
+        # Drop queued renders and let the running one finish before the window's objects go away
+        self.renderer.pool.clear()
+        self.renderer.wait()
+        super().closeEvent(event)
+
     def refresh_ui(self):
         # Update UI elements with the new state of annotations
         self.criteria_list.clear()
         for annotation in self.annotations:
             self.criteria_list.addItem(annotation['criteria'])
-        if self.selected_criteria_index is not None and self.selected_criteria_index < len(self.annotations):
+        if self.selected_criteria_index is not None and self.selected_criteria_index >= len(self.annotations):
+            # The selected criteria was removed again
+            self.selected_criteria_index = len(self.annotations) - 1 if self.annotations else None
+        if self.selected_criteria_index is not None:
             self.criteria_list.setCurrentRow(self.selected_criteria_index)
         self.update_entity_list(self.annotations[self.selected_criteria_index] if self.selected_criteria_index is not None else None)
         self.show_page()
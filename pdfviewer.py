@@ -0,0 +1,530 @@
+import math
+import threading
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+from PyQt6 import QtCore, QtGui, QtWidgets
+
+# Side of a zoomed-in tile, in screen pixels
+TILE_PIXELS = 512
+
+def pixmap_to_qimage(pix):
+    # Wraps the MuPDF samples directly, without a PIL round-trip. The QImage shares pix's buffer,
+    # so convert it (QPixmap.fromImage) or copy it before pix goes away.
+    image_format = QtGui.QImage.Format.Format_RGBA8888 if pix.alpha else QtGui.QImage.Format.Format_RGB888
+    return QtGui.QImage(pix.samples_mv, pix.width, pix.height, pix.stride, image_format)
+
+class PageRenderCache:
+    # Rendered pages keyed by (page index, zoom), so selecting, renaming or drawing boxes only
+    # repaints the overlays. The least recently used pages are dropped once the cached pixmaps
+    # pass max_mb. Call clear() when another PDF is opened.
+
+    def __init__(self, max_mb=256):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.pixmaps = OrderedDict()
+        self.size = 0
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.pixmaps
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        old = self.pixmaps.pop(key, None)
+        if old is not None:
+            self.size -= self.pixmap_bytes(old)
+        self.pixmaps[key] = pixmap
+        self.size += self.pixmap_bytes(pixmap)
+        # Never evict the page just added, even if it alone is over the cap
+        while self.size > self.max_bytes and len(self.pixmaps) > 1:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.size -= self.pixmap_bytes(evicted)
+
+    @staticmethod
+    def pixmap_bytes(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+# The render thread's own open document; MuPDF documents must not be shared between threads
+render_documents = threading.local()
+
+def render_document(pdf_path):
+    document = getattr(render_documents, "document", None)
+    if document is None or render_documents.path != pdf_path:
+        if document is not None:
+            document.close()
+        document = render_documents.document = fitz.open(pdf_path)
+        render_documents.path = pdf_path
+    return document
+
+def render_image(pdf_path, page_index, zoom, tile=None):
+    # The whole page, or with tile=(column, row) only that TILE_PIXELS square of it
+    page = render_document(pdf_path).load_page(page_index)
+    clip = None
+    if tile is not None:
+        step = TILE_PIXELS / zoom
+        clip = fitz.Rect(tile[0] * step, tile[1] * step, (tile[0] + 1) * step, (tile[1] + 1) * step) & page.rect
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    # Copy out of pix's buffer, which is freed with pix
+    return pixmap_to_qimage(pix).copy()
+
+class WordIndex:
+    # The words of one page in a grid of CELL-point cells, so the word under the cursor or the words
+    # touching a box are found by checking a cell or two instead of every word on the page
+    CELL = 32.0
+
+    def __init__(self, words):
+        # words as returned by page.get_text("words")
+        self.words = [(x0, y0, x1, y1, text) for x0, y0, x1, y1, text, *_ in words]
+        self.cells = {}
+        for index, word in enumerate(self.words):
+            for cell in self.cells_in(*word[:4]):
+                self.cells.setdefault(cell, []).append(index)
+
+    def cells_in(self, x0, y0, x1, y1):
+        for column in range(math.floor(x0 / self.CELL), math.floor(x1 / self.CELL) + 1):
+            for row in range(math.floor(y0 / self.CELL), math.floor(y1 / self.CELL) + 1):
+                yield (column, row)
+
+    def word_at(self, x, y):
+        for index in self.cells.get((math.floor(x / self.CELL), math.floor(y / self.CELL)), ()):
+            x0, y0, x1, y1, _ = self.words[index]
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                return self.words[index]
+        return None
+
+    def words_in(self, x0, y0, x1, y1):
+        # Words on a line the box covers (their vertical centre is inside it) that the box overlaps
+        # horizontally, in reading order. Words of a line the box only touches are left out: line
+        # boxes overlap at normal leading, so touching would pull in the next line.
+        found = set()
+        for cell in self.cells_in(x0, y0, x1, y1):
+            for index in self.cells.get(cell, ()):
+                word = self.words[index]
+                if word[0] < x1 and word[2] > x0 and y0 <= (word[1] + word[3]) / 2 <= y1:
+                    found.add(index)
+        return [self.words[index] for index in sorted(found)]
+
+def box_from_points(x0, y0, x1, y1, word_index=None):
+    # Criteria JSON box for a rectangle drawn between two points. With a word index the box grows to
+    # the whole of every word it cuts on the lines it covers, again until it stops growing, so no
+    # word is cut off at the edge; it never shrinks. Rounded outwards to whole points.
+    x0, x1 = min(x0, x1), max(x0, x1)
+    y0, y1 = min(y0, y1), max(y0, y1)
+    while word_index is not None:
+        bounds = (x0, y0, x1, y1)
+        for word in word_index.words_in(x0, y0, x1, y1):
+            x0, y0 = min(x0, word[0]), min(y0, word[1])
+            x1, y1 = max(x1, word[2]), max(y1, word[3])
+        if (x0, y0, x1, y1) == bounds:
+            break
+    x0, y0 = math.floor(x0), math.floor(y0)
+    return {"x": x0, "y": y0, "width": math.ceil(x1) - x0, "height": math.ceil(y1) - y0}
+
+class WordIndexTask(QtCore.QRunnable):
+    def __init__(self, renderer, generation, page_index):
+        super().__init__()
+        self.renderer = renderer
+        self.pdf_path = renderer.pdf_path
+        self.generation = generation
+        self.page_index = page_index
+
+    def run(self):
+        if self.generation != self.renderer.generation:
+            return
+        try:
+            word_index = WordIndex(render_document(self.pdf_path).load_page(self.page_index).get_text("words"))
+        except Exception:
+            return  # Boxes on this page are drawn without snapping
+        self.renderer.index_ready.emit(self.generation, self.page_index, word_index)
+
+class RenderTask(QtCore.QRunnable):
+    def __init__(self, renderer, generation, key):
+        super().__init__()
+        self.renderer = renderer
+        self.pdf_path = renderer.pdf_path
+        self.generation = generation
+        self.key = key  # (page index, zoom) or (page index, zoom, tile)
+
+    def run(self):
+        self.renderer.queued_tiles.discard(self.key)
+        # Skip work another PDF, a scroll or an earlier task has made unnecessary
+        if self.generation != self.renderer.generation or self.key in self.renderer.cache:
+            return
+        if len(self.key) == 3 and self.key not in self.renderer.wanted_tiles:
+            return
+        try:
+            image = render_image(self.pdf_path, *self.key)
+        except Exception:
+            return  # The page stays on its preview or previous render
+        self.renderer.image_ready.emit(self.generation, self.key, image)
+
+class PageRenderer(QtCore.QObject):
+    # Renders pages off the GUI thread. request() returns the best render available right away: the
+    # page at the asked zoom, or a low-resolution preview, or None. Sharper renders arrive through the
+    # rendered signal. The next and previous pages are prefetched at the same zoom, and queued renders
+    # for pages the user has moved away from are dropped on every request.
+    #
+    # Pages are never rendered whole above max_page_pixels: past that zoom the page is shown at the
+    # largest zoom that fits, and request_tiles() renders the visible part at the full zoom in
+    # TILE_PIXELS squares, cached by (page, zoom, tile) and delivered through tile_rendered.
+    #
+    # The first request for a page also builds its WordIndex on the render thread; word_index()
+    # returns None until it is ready.
+    PREVIEW_ZOOM = 0.5
+
+    rendered = QtCore.pyqtSignal(int, QtGui.QPixmap, float)  # page index, pixmap, zoom it was rendered at
+    tile_rendered = QtCore.pyqtSignal(object, QtGui.QPixmap)  # (page index, zoom, tile), pixmap
+    image_ready = QtCore.pyqtSignal(int, object, QtGui.QImage)  # From the render thread
+    index_ready = QtCore.pyqtSignal(int, int, object)  # From the render thread
+
+    def __init__(self, max_mb=256, max_page_pixels=4_000_000, parent=None):
+        super().__init__(parent)
+        self.cache = PageRenderCache(max_mb)
+        self.max_page_pixels = max_page_pixels
+        self.pool = QtCore.QThreadPool(self)
+        # One render thread: MuPDF is not thread-safe, and the thread keeps its own document open
+        self.pool.setMaxThreadCount(1)
+        self.pdf_path = None
+        self.pdf_document = None
+        self.page_sizes = {}
+        self.generation = 0
+        self.wanted = None  # (page index, zoom) on screen
+        self.wanted_tiles = set()  # Tiles on screen
+        self.queued_tiles = set()
+        self.word_indexes = OrderedDict()  # page index -> WordIndex, for the last 64 pages
+        self.image_ready.connect(self.store_image)
+        self.index_ready.connect(self.store_word_index)
+
+    def open(self, pdf_path, pdf_document):
+        # pdf_document is the caller's own copy, used for page sizes only
+        self.pool.clear()
+        self.generation += 1
+        self.pdf_path = pdf_path
+        self.pdf_document = pdf_document
+        self.page_sizes = {}
+        self.wanted = None
+        self.wanted_tiles = set()
+        self.queued_tiles = set()
+        self.word_indexes.clear()
+        self.cache.clear()
+
+    def page_size(self, page_index):
+        if page_index not in self.page_sizes:
+            rect = self.pdf_document.load_page(page_index).rect
+            self.page_sizes[page_index] = (rect.width, rect.height)
+        return self.page_sizes[page_index]
+
+    def page_zoom(self, page_index, zoom):
+        # Zoom the whole page is rendered at: zoom itself, unless that goes over max_page_pixels
+        width, height = self.page_size(page_index)
+        if width * height * zoom * zoom <= self.max_page_pixels:
+            return zoom
+        return round(math.sqrt(self.max_page_pixels / (width * height)), 4)
+
+    def request(self, page_index, zoom):
+        # Returns (pixmap, zoom it was rendered at) or None
+        zoom = self.page_zoom(page_index, round(zoom, 4))
+        self.wanted = (page_index, zoom)
+        # Drop queued renders left over from pages and zoom levels the user has moved past
+        self.pool.clear()
+        self.queued_tiles = set()
+
+        result = None
+        pixmap = self.cache.get((page_index, zoom))
+        if pixmap is not None:
+            result = (pixmap, zoom)
+        else:
+            if zoom > self.PREVIEW_ZOOM:
+                preview = self.cache.get((page_index, self.PREVIEW_ZOOM))
+                if preview is not None:
+                    result = (preview, self.PREVIEW_ZOOM)
+                else:
+                    self.schedule((page_index, self.PREVIEW_ZOOM), priority=2)
+            self.schedule((page_index, zoom), priority=1)
+        if page_index not in self.word_indexes:
+            # After the preview, before the sharp page
+            self.pool.start(WordIndexTask(self, self.generation, page_index), 2)
+
+        for neighbour in (page_index + 1, page_index - 1):
+            if 0 <= neighbour < len(self.pdf_document):
+                self.schedule((neighbour, self.page_zoom(neighbour, zoom)), priority=0)
+        return result
+
+    def request_tiles(self, page_index, zoom, visible):
+        # visible is the part of the page on screen, in PDF points. Returns the [(key, pixmap)] tiles
+        # already rendered; the rest arrive through tile_rendered. Empty below the tiling zoom.
+        zoom = round(zoom, 4)
+        self.wanted_tiles = set()
+        if self.pdf_document is None or self.page_zoom(page_index, zoom) == zoom:
+            return []
+        width, height = self.page_size(page_index)
+        visible = visible.intersected(QtCore.QRectF(0, 0, width, height))
+        if visible.isEmpty():
+            return []
+
+        step = TILE_PIXELS / zoom
+        ready = []
+        for row in range(int(visible.top() // step), math.ceil(visible.bottom() / step)):
+            for column in range(int(visible.left() // step), math.ceil(visible.right() / step)):
+                key = (page_index, zoom, (column, row))
+                self.wanted_tiles.add(key)
+                pixmap = self.cache.get(key)
+                if pixmap is not None:
+                    ready.append((key, pixmap))
+                elif key not in self.queued_tiles:
+                    self.queued_tiles.add(key)
+                    self.pool.start(RenderTask(self, self.generation, key), 1)
+        return ready
+
+    def schedule(self, key, priority):
+        if key not in self.cache:
+            self.pool.start(RenderTask(self, self.generation, key), priority)
+
+    def store_image(self, generation, key, image):
+        if generation != self.generation:
+            return
+        pixmap = QtGui.QPixmap.fromImage(image)
+        self.cache.put(key, pixmap)
+        if len(key) == 3:
+            if key in self.wanted_tiles:
+                self.tile_rendered.emit(key, pixmap)
+            return
+        page_index, zoom = key
+        if self.wanted is None or page_index != self.wanted[0]:
+            return
+        # A late preview must not replace the sharp page
+        if zoom == self.wanted[1] or (zoom == self.PREVIEW_ZOOM and self.wanted not in self.cache):
+            self.rendered.emit(page_index, pixmap, zoom)
+
+    def word_index(self, page_index):
+        return self.word_indexes.get(page_index)
+
+    def store_word_index(self, generation, page_index, word_index):
+        if generation != self.generation:
+            return
+        self.word_indexes[page_index] = word_index
+        while len(self.word_indexes) > 64:
+            self.word_indexes.popitem(last=False)
+
+    def wait(self):
+        self.pool.waitForDone()
+
+def rect_data_from(rect):
+    # Criteria JSON box for a scene rectangle; scene units are PDF points
+    # Rounded outwards to whole points, like box_from_points, so a box never loses a sliver of text
+    rect = rect.normalized()
+    x0, y0 = math.floor(rect.left()), math.floor(rect.top())
+    return {"x": x0, "y": y0, "width": math.ceil(rect.right()) - x0, "height": math.ceil(rect.bottom()) - y0}
+
+class BoxItem(QtWidgets.QGraphicsRectItem):
+    # A criteria or entity box on the page. Drag its outline to move it, drag its bottom-right corner
+    # to resize it; the view's box_changed signal then reports the new box for key. Only the outline
+    # and the corner take presses, so a new box can still be drawn inside an existing one.
+    HANDLE_PIXELS = 8
+
+    def __init__(self, key, rect_data, color, label=None, dashed=False, editable=True):
+        super().__init__(0, 0, rect_data.get("width", 0), rect_data.get("height", 0))
+        self.key = key
+        self.setPos(rect_data.get("x", 0), rect_data.get("y", 0))
+        pen = QtGui.QPen(color, 2, QtCore.Qt.PenStyle.DotLine if dashed else QtCore.Qt.PenStyle.SolidLine)
+        pen.setCosmetic(True)  # Same width at every zoom
+        self.setPen(pen)
+        self.resizing = False
+        self.start_geometry = None
+        if editable:
+            self.setFlags(QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemIsMovable | QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemIsSelectable)
+            self.setAcceptHoverEvents(True)
+        if label:
+            text = QtWidgets.QGraphicsSimpleTextItem(label, self)
+            text.setFont(QtGui.QFont("Arial", 10))
+            # Readable at every zoom, 16 pixels above the box
+            text.setFlag(QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemIgnoresTransformations)
+            text.setTransform(QtGui.QTransform.fromTranslate(0, -16))
+
+    def view_scale(self):
+        views = self.scene().views() if self.scene() else []
+        return views[0].transform().m11() if views else 1.0
+
+    def on_handle(self, position):
+        handle = self.HANDLE_PIXELS / self.view_scale()
+        rect = self.rect()
+        return abs(position.x() - rect.right()) <= handle and abs(position.y() - rect.bottom()) <= handle
+
+    def shape(self):
+        if not self.flags() & QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemIsMovable:
+            return super().shape()
+        grip = self.HANDLE_PIXELS / self.view_scale()
+        outline = QtGui.QPainterPath()
+        outline.addRect(self.rect())
+        stroker = QtGui.QPainterPathStroker()
+        stroker.setWidth(grip)
+        path = stroker.createStroke(outline)
+        corner = self.rect().bottomRight()
+        path.addRect(QtCore.QRectF(corner.x() - grip, corner.y() - grip, 2 * grip, 2 * grip))
+        return path.simplified()
+
+    def hoverMoveEvent(self, event):
+        self.setCursor(QtCore.Qt.CursorShape.SizeFDiagCursor if self.on_handle(event.pos()) else QtCore.Qt.CursorShape.SizeAllCursor)
+        super().hoverMoveEvent(event)
+
+    def mousePressEvent(self, event):
+        self.start_geometry = (self.pos(), self.rect())
+        self.resizing = event.button() == QtCore.Qt.MouseButton.LeftButton and self.on_handle(event.pos())
+        if self.resizing:
+            event.accept()
+        else:
+            super().mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self.resizing:
+            self.setRect(QtCore.QRectF(0, 0, max(1.0, event.pos().x()), max(1.0, event.pos().y())))
+        else:
+            super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        super().mouseReleaseEvent(event)
+        self.resizing = False
+        if self.start_geometry != (self.pos(), self.rect()):
+            views = self.scene().views()
+            if views:
+                rect_data = rect_data_from(self.mapRectToScene(self.rect()))
+                if self.rect() == self.start_geometry[1]:
+                    # A plain move keeps the size and snaps to the nearest point, so moving a box
+                    # never grows it
+                    rect_data["x"], rect_data["y"] = round(self.scenePos().x()), round(self.scenePos().y())
+                    rect_data["width"], rect_data["height"] = round(self.rect().width()), round(self.rect().height())
+                views[0].box_changed.emit(self.key, rect_data)
+
+class PageView(QtWidgets.QGraphicsView):
+    # Page viewer: the rendered page is one pixmap item, criteria and entity boxes are separate items
+    # in PDF points on top of it, and zoom is the view transform, so changing a box or the zoom never
+    # repaints the page. Presses on empty page area are reported in PDF points for drawing new boxes.
+    pressed = QtCore.pyqtSignal(object, QtCore.QPointF)  # button, position
+    moved = QtCore.pyqtSignal(QtCore.QPointF)
+    released = QtCore.pyqtSignal(object, QtCore.QPointF)
+    zoom_requested = QtCore.pyqtSignal(int)  # +1 zoom in, -1 zoom out
+    box_changed = QtCore.pyqtSignal(object, dict)  # key, {"x", "y", "width", "height"}
+    viewport_changed = QtCore.pyqtSignal()  # Scrolled, resized or zoomed
+    hovered = QtCore.pyqtSignal(QtCore.QPointF)  # Mouse moved while not drawing
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setScene(QtWidgets.QGraphicsScene(self))
+        self.setMouseTracking(True)
+        self.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop | QtCore.Qt.AlignmentFlag.AlignLeft)
+        self.setBackgroundBrush(QtGui.QBrush(QtCore.Qt.GlobalColor.white))
+        self.page_item = self.scene().addPixmap(QtGui.QPixmap())
+        self.page_item.setZValue(-1)
+        self.page_item.setTransformationMode(QtCore.Qt.TransformationMode.SmoothTransformation)
+        self.boxes = []
+        self.tiles = {}  # (page index, zoom, tile) -> sharp tile item over the page
+        self.hover_item = self.scene().addRect(QtCore.QRectF(), QtGui.QPen(QtCore.Qt.PenStyle.NoPen), QtGui.QColor(255, 200, 0, 90))
+        self.hover_item.setZValue(-0.25)  # Over the page and its tiles, under the boxes
+        self.hover_item.hide()
+        self.drawing = False
+        self.zoom = 1.0
+
+    def set_page(self, pixmap, pixmap_zoom, zoom=None):
+        # pixmap was rendered at pixmap_zoom; it is scaled back to PDF points and the view shows it at zoom
+        self.page_item.setPixmap(pixmap)
+        self.page_item.setScale(1 / pixmap_zoom)
+        self.scene().setSceneRect(self.page_item.sceneBoundingRect())
+        self.set_zoom(pixmap_zoom if zoom is None else zoom)
+
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+        self.setTransform(QtGui.QTransform.fromScale(zoom, zoom))
+        self.viewport_changed.emit()
+
+    def visible_rect(self):
+        # The part of the scene on screen, in PDF points
+        return self.mapToScene(self.viewport().rect()).boundingRect()
+
+    def set_tile(self, key, pixmap):
+        if key in self.tiles:
+            return
+        _, zoom, (column, row) = key
+        item = self.scene().addPixmap(pixmap)
+        item.setScale(1 / zoom)
+        item.setPos(column * TILE_PIXELS / zoom, row * TILE_PIXELS / zoom)
+        item.setZValue(-0.5)  # Over the page, under the boxes
+        self.tiles[key] = item
+
+    def retain_tiles(self, keys):
+        for key in [key for key in self.tiles if key not in keys]:
+            self.scene().removeItem(self.tiles.pop(key))
+
+    def clear_tiles(self):
+        self.retain_tiles(())
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self.viewport_changed.emit()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.viewport_changed.emit()
+
+    def set_hover(self, bounds):
+        # Highlights the (x0, y0, x1, y1) word under the cursor; None hides the highlight
+        if bounds is None:
+            self.hover_item.hide()
+            return
+        self.hover_item.setRect(QtCore.QRectF(QtCore.QPointF(bounds[0], bounds[1]), QtCore.QPointF(bounds[2], bounds[3])))
+        self.hover_item.show()
+
+    def clear_boxes(self):
+        for item in self.boxes:
+            self.scene().removeItem(item)
+        self.boxes = []
+
+    def add_box(self, key, rect_data, color, label=None, dashed=False, editable=True):
+        item = BoxItem(key, rect_data, color, label, dashed, editable)
+        self.scene().addItem(item)
+        self.boxes.append(item)
+        return item
+
+    def box_at(self, position):
+        # Topmost editable box under position; highlight-only boxes let presses through
+        for item in self.items(position):
+            while item is not None and not isinstance(item, BoxItem):
+                item = item.parentItem()
+            if item is not None and item.flags() & QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemIsMovable:
+                return item
+        return None
+
+    def mousePressEvent(self, event):
+        if self.box_at(event.position().toPoint()) is not None:
+            super().mousePressEvent(event)
+            return
+        self.drawing = True
+        self.pressed.emit(event.button(), self.mapToScene(event.position().toPoint()))
+
+    def mouseMoveEvent(self, event):
+        if self.drawing:
+            self.moved.emit(self.mapToScene(event.position().toPoint()))
+        else:
+            self.hovered.emit(self.mapToScene(event.position().toPoint()))
+            super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if self.drawing:
+            self.drawing = False
+            self.released.emit(event.button(), self.mapToScene(event.position().toPoint()))
+        else:
+            super().mouseReleaseEvent(event)
+
+    def wheelEvent(self, event):
+        # Ctrl + wheel zooms, the plain wheel scrolls
+        if event.modifiers() == QtCore.Qt.KeyboardModifier.ControlModifier:
+            self.zoom_requested.emit(1 if event.angleDelta().y() > 0 else -1)
+        else:
+            super().wheelEvent(event)
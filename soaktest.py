@@ -0,0 +1,284 @@
+import argparse
+import csv
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import fitz  # PyMuPDF
+
+from entityextractor import logger, setup_logging, current_rss_mb, process_all_pdfs_multi, WorkerPool
+
+# Optional: child process RSS and descriptor counts on every platform; /proc is read on Linux without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def generate_corpus(criteria_file, output_directory, pdf_count=50, max_pages=8, seed=0):
+    # Writes PDFs whose pages match the criteria file's templates: each page gets one template's
+    # criteria strings inside their boxes and sample values inside the entity boxes, plus some
+    # pages that match nothing. Seeded, so the same arguments always give the same corpus.
+    with open(criteria_file, 'r') as file:
+        documents = json.load(file)["documents"]
+    templates = []
+    for document in documents:
+        criteria_sets = document.get("criteria_sets", [])
+        if criteria_sets and all(isinstance(criteria_set, dict) and isinstance(criteria_set.get("criteria_box"), dict) for criteria_set in criteria_sets):
+            templates.append(document)
+
+    def place_text(page, coords, text):
+        x, y = float(coords["x"]), float(coords["y"])
+        width, height = float(coords["width"]), float(coords["height"])
+        # Small enough for the whole string to stay inside the box
+        fontsize = max(1.0, min(11.0, 0.7 * height, width / (0.6 * len(text) + 1)))
+        page.insert_text((x + 1, y + height / 2 + fontsize / 3), text, fontsize=fontsize)
+
+    random_state = random.Random(seed)
+    os.makedirs(output_directory, exist_ok=True)
+    for pdf_index in range(pdf_count):
+        doc = fitz.open()
+        for page_index in range(random_state.randint(1, max_pages)):
+            page = doc.new_page()
+            if not templates or random_state.random() < 0.2:
+                page.insert_text((72, 72), f"Filler page {page_index + 1}")
+                continue
+            document = random_state.choice(templates)
+            for criteria_set in document["criteria_sets"]:
+                place_text(page, criteria_set["criteria_box"], str(criteria_set.get("criteria", "")))
+            for entity in document.get("entities", []):
+                if isinstance(entity.get("coordinates"), dict):
+                    place_text(page, entity["coordinates"], f"{entity.get('name', 'Value')} {random_state.randint(1000, 999999)}")
+        doc.save(os.path.join(output_directory, f"soak_{pdf_index:05d}.pdf"))
+        doc.close()
+
+def count_pages(pdf_directory):
+    pages = 0
+    for file_name in os.listdir(pdf_directory):
+        if file_name.lower().endswith('.pdf'):
+            try:
+                with fitz.open(os.path.join(pdf_directory, file_name)) as doc:
+                    pages += len(doc)
+            except Exception as e:
+                logger.error(f"Error opening {file_name}: {e}")
+    return pages
+
+def open_file_count():
+    if psutil is not None and hasattr(psutil.Process, "num_fds"):
+        return psutil.Process().num_fds()
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+def children_rss_mb():
+    # Combined RSS of the worker processes, when psutil can see them
+    if psutil is None:
+        return None
+    total = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total / (1024 * 1024)
+
+class ResourceSampler(threading.Thread):
+    # Samples RSS and open descriptors every interval seconds while the soak runs
+    def __init__(self, interval=1.0):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.iteration = 0
+        self.started = time.monotonic()
+        self.stopped = threading.Event()
+
+    def sample(self):
+        self.samples.append({
+            "elapsed_s": round(time.monotonic() - self.started, 3),
+            "iteration": self.iteration,
+            "rss_mb": current_rss_mb(),
+            "children_rss_mb": children_rss_mb(),
+            "open_files": open_file_count()
+        })
+
+    def run(self):
+        self.sample()
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+def run_soak(pdf_directory, criteria_files, iterations, sampler=None, **options):
+    # Replays the corpus iterations times and returns one record per iteration. options are passed
+    # straight to process_all_pdfs_multi (backend, max_workers, io_threads, ...). The process backend
+    # keeps one WorkerPool for the whole run, as the daemon does, so worker growth shows up in
+    # worker_rss_mb instead of being reset by a fresh pool every iteration.
+    pages = count_pages(pdf_directory)
+    pool = None
+    if options.get("backend") == "process":
+        pool = WorkerPool(
+            criteria_files,
+            max_workers=options.get("max_workers"),
+            max_pdfs_per_worker=options.get("max_pdfs_per_worker"),
+            max_worker_rss_mb=options.get("max_worker_rss_mb"),
+            mupdf_store_mb=options.get("mupdf_store_mb"),
+            compact=options.get("compact", False)
+        )
+    try:
+        return replay(pdf_directory, criteria_files, iterations, pages, sampler, pool, options)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+def replay(pdf_directory, criteria_files, iterations, pages, sampler, pool, options):
+    records = []
+    for iteration in range(1, iterations + 1):
+        if sampler is not None:
+            sampler.iteration = iteration
+        started = time.perf_counter()
+        all_data = process_all_pdfs_multi(pdf_directory, criteria_files, pool=pool, **options)
+        seconds = time.perf_counter() - started
+        rows = [len(pdf_data) for pdf_data in all_data]
+        del all_data
+        # Measure what is still held after the results are dropped, not garbage waiting for a collection
+        gc.collect()
+        record = {
+            "iteration": iteration,
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(pages / seconds, 2) if seconds else None,
+            "rss_mb": current_rss_mb(),
+            "worker_rss_mb": children_rss_mb() if pool is not None else None,
+            "open_files": open_file_count(),
+            "rows": rows
+        }
+        records.append(record)
+        workers = f", workers {record['worker_rss_mb']:.0f} MB" if record["worker_rss_mb"] is not None else ""
+        print(f"Iteration {iteration}/{iterations}: {record['seconds']}s, {record['pages_per_second']} pages/s, "
+              f"RSS {record['rss_mb'] or 0:.0f} MB{workers}, {record['open_files']} open files, rows {rows}")
+    return records
+
+def window_mean(records, key):
+    values = [record[key] for record in records if record[key] is not None]
+    return sum(values) / len(values) if values else None
+
+def check_drift(records, warmup=1, window=3, max_rss_growth_mb=50.0, max_fd_growth=5, max_slowdown_pct=20.0,
+                max_worker_rss_growth_mb=100.0):
+    # Compares the first window of iterations after warmup with the last window and returns the
+    # failures found: parent or worker resident memory or descriptor growth, throughput loss, or
+    # changing row counts
+    failures = []
+    measured = records[warmup:]
+    if len(measured) < 2:
+        return ["Not enough iterations after warmup to compare"]
+    window = max(1, min(window, len(measured) // 2))
+    first, last = measured[:window], measured[-window:]
+
+    for key, limit, unit in (("rss_mb", max_rss_growth_mb, " MB"), ("worker_rss_mb", max_worker_rss_growth_mb, " MB"),
+                             ("open_files", max_fd_growth, "")):
+        before, after = window_mean(first, key), window_mean(last, key)
+        if before is not None and after is not None and after - before > limit:
+            failures.append(f"{key} grew by {after - before:.1f}{unit} ({before:.1f} -> {after:.1f}), limit {limit}{unit}")
+
+    before, after = window_mean(first, "pages_per_second"), window_mean(last, "pages_per_second")
+    if before and after is not None:
+        slowdown = 100 * (before - after) / before
+        if slowdown > max_slowdown_pct:
+            failures.append(f"Throughput dropped {slowdown:.1f}% ({before:.1f} -> {after:.1f} pages/s), limit {max_slowdown_pct}%")
+
+    row_counts = {tuple(record["rows"]) for record in records}
+    if len(row_counts) > 1:
+        failures.append(f"Row counts changed between iterations: {sorted(row_counts)}")
+    return failures
+
+def write_samples(samples, samples_file):
+    if not samples:
+        return
+    with open(samples_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(samples[0]))
+        writer.writeheader()
+        writer.writerows(samples)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a PDF corpus repeatedly and fail on memory, descriptor or throughput drift.")
+    parser.add_argument("--criteria", nargs="+", required=True)
+    parser.add_argument("--pdf-directory", default=None, help="Corpus to replay; a corpus is generated from the first criteria file without it")
+    parser.add_argument("--generate", type=int, default=50, metavar="PDF_COUNT", help="PDFs to generate when no --pdf-directory is given")
+    parser.add_argument("--max-pages", type=int, default=8, help="Pages per generated PDF, at most")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=1, help="Iterations left out of the comparison while caches fill")
+    parser.add_argument("--window", type=int, default=3, help="Iterations averaged at the start and end of the run")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=50.0)
+    parser.add_argument("--max-worker-rss-growth-mb", type=float, default=100.0, help="Combined worker RSS growth allowed with --backend process")
+    parser.add_argument("--max-fd-growth", type=int, default=5)
+    parser.add_argument("--max-slowdown-pct", type=float, default=20.0)
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Seconds between RSS and descriptor samples")
+    parser.add_argument("--samples-csv", default=None, help="Write the timed samples to this CSV file")
+    parser.add_argument("--report", default=None, help="Write the per-iteration records and failures to this JSON file")
+    # Passed through to the extraction engine
+    parser.add_argument("--backend", choices=["thread", "process"], default="thread")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--io-threads", type=int, default=None)
+    parser.add_argument("--max-pdfs-per-worker", type=int, default=None)
+    parser.add_argument("--max-worker-rss-mb", type=float, default=None)
+    parser.add_argument("--mupdf-store-mb", type=float, default=None)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--log-level", default="WARNING", help="Extraction log level; INFO logs every match")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    logger.setLevel(args.log_level)
+
+    corpus_temp = None
+    pdf_directory = args.pdf_directory
+    if pdf_directory is None:
+        corpus_temp = tempfile.TemporaryDirectory(prefix="soak_corpus_")
+        pdf_directory = corpus_temp.name
+        generate_corpus(args.criteria[0], pdf_directory, args.generate, args.max_pages, args.seed)
+        print(f"Generated {args.generate} PDFs in {pdf_directory}")
+
+    sampler = ResourceSampler(args.sample_interval)
+    sampler.start()
+    try:
+        records = run_soak(
+            pdf_directory, args.criteria, args.iterations, sampler,
+            backend=args.backend,
+            max_workers=args.workers,
+            io_threads=args.io_threads,
+            max_pdfs_per_worker=args.max_pdfs_per_worker,
+            max_worker_rss_mb=args.max_worker_rss_mb,
+            mupdf_store_mb=args.mupdf_store_mb,
+            compact=args.compact,
+            schedule="listing"
+        )
+    finally:
+        sampler.stop()
+        if corpus_temp:
+            corpus_temp.cleanup()
+
+    failures = check_drift(records, args.warmup, args.window, args.max_rss_growth_mb, args.max_fd_growth, args.max_slowdown_pct,
+                           args.max_worker_rss_growth_mb)
+    if args.samples_csv:
+        write_samples(sampler.samples, args.samples_csv)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump({"iterations": records, "failures": failures}, file, indent=4)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print(f"PASS: {len(records)} iterations within limits")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())